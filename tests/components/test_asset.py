@@ -1,5 +1,7 @@
-from tofina.components import asset
+from tofina.components import asset, store
 import torch
+import shutil
+import pytest
 import numpy as np
 from tofina import utils
 
@@ -75,3 +77,151 @@ def test_AssetObj():
     assert np.corrcoef(simulated[0].flatten(), simulated[1].flatten())[0][1] > 0.25
     for i in [0, 1]:
         stock_assertion(simulated[i])
+
+
+def test_AssetRandomStreams():
+    def makeAsset(name, seed=1):
+        return asset.Asset(
+            name,
+            asset.CompanyValueNormalDistributionProcess,
+            10,
+            1000,
+            seed=seed,
+            mean=0.065,
+            std=0.2,
+            initialValue=100,
+        )
+
+    torch.manual_seed(0)
+    globalState = torch.get_rng_state()
+    testAsset = makeAsset("testStock")
+    assert (torch.get_rng_state() == globalState).all()
+
+    assert (testAsset.simulate() == testAsset.monteCarloSimulation).all()
+    assert (makeAsset("testStock").monteCarloSimulation == testAsset.simulate()).all()
+    assert (testAsset.simulate(chunkIndex=1) != testAsset.simulate()).any()
+    assert (makeAsset("otherStock").monteCarloSimulation != testAsset.simulate()).any()
+    assert (
+        makeAsset("testStock", 2).monteCarloSimulation != testAsset.simulate()
+    ).any()
+
+    def legacyProcess(processLength, monteCarloTrials, params):
+        return torch.rand((monteCarloTrials, processLength))
+
+    legacyAsset = asset.Asset("testStock", legacyProcess, 10, 1000)
+    assert (legacyAsset.simulate() == legacyAsset.monteCarloSimulation).all()
+    assert (torch.get_rng_state() == globalState).all()
+
+
+def test_SamplingModes():
+    for sampling in ["antithetic", "sobol"]:
+        testAsset = asset.Asset(
+            "testStock",
+            asset.CompanyValueNormalDistributionProcess,
+            10,
+            1000,
+            sampling=sampling,
+            mean=0.065,
+            std=0.2,
+            initialValue=100,
+        )
+        stock_assertion(testAsset.monteCarloSimulation)
+
+    shocks = asset.normalShocks(1000, 10, sampling="antithetic")
+    assert (shocks[:500] == -shocks[500:]).all()
+    assert (shocks[:, 0] == 0).all()
+
+    shocks = asset.normalShocks(4096, 9, sampling="sobol")
+    assert (shocks[:, 1:].mean(axis=0).abs() < 0.05).all()
+    assert ((shocks[:, 1:].std(axis=0) - 1).abs() < 0.05).all()
+    assert (shocks[:, 1:].sum(axis=1).std() - np.sqrt(8)).abs() < 0.05
+
+    def legacyProcess(processLength, monteCarloTrials, params):
+        return torch.rand((monteCarloTrials, processLength))
+
+    with pytest.warns(UserWarning):
+        legacyAsset = asset.Asset(
+            "testStock", legacyProcess, 10, 1000, sampling="sobol"
+        )
+    assert legacyAsset.sampling == "pseudo"
+    assert legacyAsset.monteCarloSimulation.shape == (1000, 10)
+    with pytest.raises(ValueError):
+        asset.Asset("testStock", legacyProcess, 10, 1000, sampling="quasi")
+
+
+processCalls = []
+
+
+def countedProcess(processLength, monteCarloTrials, params, generator=None):
+    processCalls.append(monteCarloTrials)
+    return asset.CompanyValueNormalDistributionProcess(
+        processLength, monteCarloTrials, params, generator=generator
+    )
+
+
+def test_SimulationStore():
+    shutil.rmtree("./tests/results/simulationStore", ignore_errors=True)
+    simulationStore = store.SimulationStore("./tests/results/simulationStore")
+    params = {"mean": 0.065, "std": 0.2, "initialValue": 100}
+
+    def storedAsset(**kwargs):
+        return asset.Asset(
+            "Company",
+            countedProcess,
+            10,
+            1000,
+            simulationStore=simulationStore,
+            **{**params, **kwargs},
+        )
+
+    simulated = storedAsset().monteCarloSimulation
+    reloaded = storedAsset().monteCarloSimulation
+    assert len(processCalls) == 1
+    assert torch.equal(simulated, reloaded)
+    assert reloaded.dtype == simulated.dtype
+
+    storedAsset(std=0.3).monteCarloSimulation
+    assert len(processCalls) == 2
+    assert len(list(simulationStore.directory.glob("*.npy"))) == 2
+
+    differentiated = storedAsset()
+    differentiated.params["std"].requires_grad = True
+    differentiated.simulate()
+    assert len(processCalls) == 3
+
+    unkeyable = object()
+    key = simulationStore.key("Company", lambda *args: unkeyable, params, 0, "", 10, 1)
+    assert key is None
+
+
+def test_StoreKeysOfEditedFunctions():
+    source = """
+VOLATILITY = {volatility}
+def process(processLength, monteCarloTrials, params):
+    return torch.full((monteCarloTrials, processLength), {literal} * VOLATILITY)
+"""
+
+    def processVersion(literal, volatility):
+        namespace = {"torch": torch, "__name__": "tests.editedProcess"}
+        exec(source.format(literal=literal, volatility=volatility), namespace)
+        return namespace["process"]
+
+    keys = [
+        store.contentKey(processVersion(literal, volatility))
+        for literal, volatility in [(0.2, 1.0), (0.9, 1.0), (0.2, 2.0)]
+    ]
+    assert len(set(keys)) == 3
+    assert store.contentKey(processVersion(0.2, 1.0)) == keys[0]
+
+    # Edits of helpers, however deep, change the key of the calling process
+    source = """
+def shocks(monteCarloTrials, processLength, depth):
+    return scale(depth) * torch.ones(monteCarloTrials, processLength)
+def scale(depth):
+    return {literal} if depth == 0 else shocks(1, 1, depth - 1).item()
+def process(processLength, monteCarloTrials, params):
+    return shocks(monteCarloTrials, processLength, 1)
+"""
+    keys = [store.contentKey(processVersion(literal, None)) for literal in [0.2, 0.9]]
+    assert keys[0] != keys[1]
+    assert store.contentKey(processVersion(0.2, None)) == keys[0]
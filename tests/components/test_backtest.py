@@ -1,5 +1,268 @@
 import tofina.components.backtest as backtest
+import tofina.components.preference as preference
+import tofina.utils as utils
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from pathlib import Path
 
 
 def test_numberOfTradingDaysBetweenTwoDays():
     assert backtest.numberOfTradingDaysBetweenTwoDays("2024-02-01", "2024-02-10") == 7
+
+
+def randomWalkForecast(timestamp, ticker, processLength, monteCarloTrials, **params):
+    generator = torch.Generator().manual_seed(pd.Timestamp(timestamp).dayofyear)
+    steps = 1 + 0.02 * torch.randn(
+        monteCarloTrials, processLength, generator=generator, dtype=torch.float64
+    )
+    return 100 * steps.cumprod(axis=1)
+
+
+def stockDepositBacktester():
+    dates = pd.bdate_range("2024-01-01", periods=30)
+    timestamps = list(dates[:4])
+    backtester = backtest.Backtester(timestamps, horizon=5, monteCarloTrials=200)
+    df = pd.DataFrame({"Close": torch.linspace(100, 110, 30).double()}, index=dates)
+    backtester.stockDataFromDataFrame(df, "XYZ")
+    backtester.registerForecaster(randomWalkForecast, ["XYZ"])
+    backtester.addIntstrumentToPortfolio("XYZ", "Stock")
+    backtester.addDeposit(interestRate=0.001)
+    return backtester
+
+
+def test_parallelOptimization():
+    results = []
+    for workers in [1, 2]:
+        torch.manual_seed(0)
+        backtester = stockDepositBacktester()
+        logFolderPath = Path(f"./tests/results/backtestWorkers{workers}")
+        logFolderPath.mkdir()
+        backtester.optimizeStrategy(
+            logFolderPath, workers=workers, iterations=20, stop=False
+        )
+        assert len(list(logFolderPath.iterdir())) == 4
+        results.append(backtester)
+    serial, parallel = results
+    assert list(parallel.optimizationResults) == serial.timestamps
+    assert list(parallel.optimizers) == serial.timestamps
+    assert backtest.forkedWorker == {}
+    for timestamp in serial.timestamps:
+        optimizer_ = parallel.optimizers[timestamp]
+        assert optimizer_.portfolio is parallel.pointInTimePortfolio[timestamp]
+        assert optimizer_.optimizationResult is parallel.optimizationResults[timestamp]
+        assert utils.check_equality(
+            optimizer_.utility, serial.optimizers[timestamp].utility
+        )
+        with torch.no_grad():
+            loss, _ = optimizer_.calculateAndLogLoss()
+        assert float(loss) == serial.optimizationResults[timestamp]["final_loss"]
+        assert (
+            serial.optimizationResults[timestamp]["final_loss"]
+            == parallel.optimizationResults[timestamp]["final_loss"]
+        )
+        assert utils.check_equality(
+            serial.pointInTimePortfolio[timestamp].strategy.normalizedWeights,
+            parallel.pointInTimePortfolio[timestamp].strategy.normalizedWeights,
+        )
+
+
+def test_batchedOptimization():
+    discountedUtility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityCRRA,
+        timeDiscountFn=preference.InterestRateTimeDiscount,
+        RiskAversion=2.0,
+        interestRate=0.05,
+    )
+    configurations = {
+        "": {"iterations": 20, "stop": False},
+        "Discounted": {
+            "iterations": 200,
+            "lr": 0.05,
+            "earlyStoppingTolerance": 1e-4,
+            "optimizer": torch.optim.SGD,
+            "utility": discountedUtility,
+        },
+    }
+    for name, kwargs in configurations.items():
+        results = []
+        for batched in [False, True]:
+            torch.manual_seed(0)
+            backtester = stockDepositBacktester()
+            logFolderPath = Path(f"./tests/results/backtest{name}Batched{batched}")
+            logFolderPath.mkdir()
+            if batched:
+                backtester.optimizeStrategyBatched(logFolderPath, **kwargs)
+            else:
+                backtester.optimizeStrategy(logFolderPath, **kwargs)
+            assert len(list(logFolderPath.iterdir())) == 4
+            results.append(backtester)
+        serial, batched = results
+        for timestamp in serial.timestamps:
+            for key in ["initial_loss", "final_loss", "converged"]:
+                assert (
+                    abs(
+                        serial.optimizationResults[timestamp][key]
+                        - batched.optimizationResults[timestamp][key]
+                    )
+                    < 1e-5
+                )
+            assert utils.check_equality(
+                serial.pointInTimePortfolio[timestamp].strategy.normalizedWeights,
+                batched.pointInTimePortfolio[timestamp].strategy.normalizedWeights,
+            )
+    assert any(result["converged"] for result in batched.optimizationResults.values())
+    with pytest.raises(ValueError):
+        batched.optimizeStrategyBatched(RiskAversion=[0.5, 2.0])
+
+
+def test_tradingDaysBetween():
+    start = pd.Series(pd.to_datetime(["2024-02-01", "2024-02-03", "2024-02-10"]))
+    end = pd.Series(pd.to_datetime(["2024-02-10", "2024-02-12", "2024-02-01"]))
+    expected = [
+        backtest.numberOfTradingDaysBetweenTwoDays(s, e) for s, e in zip(start, end)
+    ]
+    assert backtest.tradingDaysBetween(start, end).tolist() == expected
+    holidays = ("2024-02-05",)
+    assert backtest.tradingDaysBetween(start, end, holidays).tolist() == [6, 5, 0]
+
+
+def test_parseOptionData():
+    backtester = stockDepositBacktester()
+    dates = [str(timestamp.date()) for timestamp in backtester.timestamps]
+    df = pd.DataFrame(
+        {
+            "Date": [dates[0], dates[0], dates[1], dates[1]],
+            "Expiry Date": ["2024-01-03", "2024-01-05", "2024-01-03", "2024-03-01"],
+            "Call Ask": [5.0, 6.0, 7.0, 8.0],
+            "Put Ask": [1.0, 2.0, 3.0, 4.0],
+            "Strike Price": [95.0, 100.0, 105.0, 110.0],
+        }
+    )
+    backtester.parseOptionData(df, "XYZ")
+    assert (
+        backtester.pointInTimePortfolio[backtester.timestamps[0]].num_instruments == 6
+    )
+    portfolio_ = backtester.pointInTimePortfolio[backtester.timestamps[1]]
+    assert portfolio_.num_instruments == 2 + 2
+    prices = [
+        float(instrument_.price) for instrument_ in portfolio_.instruments.values()
+    ]
+    assert prices[2:] == [7.0, 3.0]
+    assert (
+        backtester.pointInTimePortfolio[backtester.timestamps[2]].num_instruments == 2
+    )
+
+
+def test_PricePanel():
+    dates = pd.bdate_range("2024-01-01", periods=10)
+    panel = backtest.PricePanel(horizon=3)
+    panel.addTicker("A", pd.Series(range(10), index=dates, dtype=float))
+    panel.addTicker("B", pd.Series([100.0, 101.0], index=dates[8:]))
+    assert panel.prices.shape == (2, 10)
+    assert panel.prices.is_contiguous()
+    assert panel.prices[1, 2:].isnan().all()
+
+    windows = panel.windows()
+    assert windows.shape == (2, 8, 3)
+    assert windows.data_ptr() == panel.prices.data_ptr()
+    assert windows[0, 4].tolist() == [4.0, 5.0, 6.0]
+
+    indices = panel.dateIndex("A", [dates[2], "2024-01-10"])
+    assert indices.tolist() == [2, 7]
+    assert panel.dateIndex("B", [dates[8]]).tolist() == [0]
+    window = panel.window("B", 0)
+    assert window.tolist() == [100.0, 101.0]
+    assert (
+        window.untyped_storage().data_ptr() == panel.prices.untyped_storage().data_ptr()
+    )
+    with pytest.raises(KeyError):
+        panel.dateIndex("A", ["2024-01-06"])
+    with pytest.raises(KeyError):
+        panel.dateIndex("B", [dates[2]])
+
+    # Appending or replacing tickers leaves views handed out earlier intact
+    windowA = panel.window("A", 0)
+    panel.addTicker(
+        "C",
+        pd.Series(
+            range(12), index=pd.bdate_range("2024-01-01", periods=12), dtype=float
+        ),
+    )
+    panel.addTicker("B", pd.Series([7.0], index=dates[:1]))
+    assert panel.prices.shape == (3, 12) and panel.prices.is_contiguous()
+    assert window.tolist() == [100.0, 101.0]
+    assert windowA.tolist() == panel.window("A", 0).tolist() == [0.0, 1.0, 2.0]
+    assert panel.window("B", 0).tolist() == [7.0]
+    assert panel.prices[1, 1:].isnan().all()
+
+    backtester = stockDepositBacktester()
+    trajectory = backtester.trajectory(backtester.timestamps[1])
+    assert trajectory["XYZ"].shape == (1, 5)
+    assert utils.check_equality(
+        trajectory["XYZ"][0], torch.linspace(100, 110, 30).double()[1:6]
+    )
+    assert list(backtester.historicalTrajectory) == backtester.timestamps
+    assert backtester.historicalTrajectory is backtester.historicalTrajectory
+
+
+def test_MisalignedCalendars():
+    dates = pd.bdate_range("2024-01-01", periods=12)
+    # B does not trade on the third day, so its windows skip it
+    datesB = dates.delete(2)
+    backtester = backtest.Backtester(list(dates[:2]), horizon=4)
+    backtester.stockDataFromDataFrame(
+        pd.DataFrame({"Close": np.arange(12.0)}, index=dates), "A"
+    )
+    assert list(backtester.historicalTrajectory[dates[1]]) == ["A"]
+    backtester.stockDataFromDataFrame(
+        pd.DataFrame({"Close": 100 + np.arange(11.0)}, index=datesB), "B"
+    )
+    assert list(backtester.historicalTrajectory[dates[1]]) == ["A", "B"]
+
+    # Window i starts on each ticker's own i-th trading day
+    windows = backtester.historicalPrices.windows()
+    assert windows[:, 2].tolist() == [
+        [2.0, 3.0, 4.0, 5.0],
+        [102.0, 103.0, 104.0, 105.0],
+    ]
+    startA, startB = [
+        int(backtester.historicalPrices.dateIndex(ticker, [dates[3]])[0])
+        for ticker in ["A", "B"]
+    ]
+    assert (startA, startB) == (3, 2)
+    assert windows[0, startA, 0] == 3.0 and windows[1, startB, 0] == 102.0
+    assert windows[1, -1].isnan().any() and not windows[0, -1].isnan().any()
+    trajectory = backtester.trajectory(dates[1])
+    assert trajectory["A"].tolist() == [[1.0, 2.0, 3.0, 4.0]]
+    assert trajectory["B"].tolist() == [[101.0, 102.0, 103.0, 104.0]]
+    assert not any(
+        trajectory_.isnan().any()
+        for prices in backtester.historicalTrajectory.values()
+        for trajectory_ in prices.values()
+    )
+
+    backtester = backtest.Backtester([dates[2]], horizon=4)
+    backtester.stockDataFromDataFrame(
+        pd.DataFrame({"Close": np.arange(12.0)}, index=dates), "A"
+    )
+    with pytest.raises(KeyError):
+        backtester.stockDataFromDataFrame(
+            pd.DataFrame({"Close": np.arange(11.0)}, index=datesB), "B"
+        )
+
+
+def test_forecasterBinding():
+    def labelForecast(timestamp, ticker, processLength, monteCarloTrials, **params):
+        label = pd.Timestamp(timestamp).day + (100 if ticker == "ABC" else 0)
+        return torch.full((monteCarloTrials, processLength), float(label))
+
+    timestamps = list(pd.bdate_range("2024-01-02", periods=3))
+    backtester = backtest.Backtester(timestamps, horizon=5, monteCarloTrials=10)
+    backtester.registerForecaster(labelForecast, ["XYZ", "ABC"])
+    for timestamp in timestamps:
+        portfolio_ = backtester.pointInTimePortfolio[timestamp]
+        for ticker, offset in [("XYZ", 0), ("ABC", 100)]:
+            simulation = portfolio_.getMonteCarloSimulation(ticker)
+            assert (simulation == timestamp.day + offset).all()
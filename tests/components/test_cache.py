@@ -0,0 +1,109 @@
+import torch
+from tofina.components import cache, portfolio, asset, instrument, strategy
+import tofina.utils as utils
+from tofina.constants import (
+    ASSET_CACHE_KEY,
+    EFFECTIVE_RETURNS_CACHE_KEY,
+    LIQUIDATIONS_CACHE_KEY,
+    RETURNS_CACHE_KEY,
+)
+
+
+def test_CacheBudgetEviction():
+    budget = cache.CacheBudget(max_bytes=2 * 400)
+    first = cache.CalculationCache(budget)
+    second = cache.CalculationCache(budget)
+    for cache_ in [first, second]:
+        cache_.register_key("x")
+        cache_.register_key("y")
+
+    def tensor():
+        return torch.zeros(100)
+
+    first(tensor, "x")()
+    second(tensor, "x")()
+    first(tensor, "x")()
+    assert budget.total_bytes == 800
+    # second["x"] is the least recently used entry across both caches
+    first(tensor, "y")()
+    assert "x" not in second.storage
+    assert set(first.storage) == {"x", "y"}
+    assert budget.total_bytes == 800
+    assert budget.evictions == 1
+
+    second(tensor, "x")()
+    assert first.stats["x"] == {
+        "hits": 1,
+        "misses": 1,
+        "stale": 0,
+        "evictions": 1,
+        "compute_time": first.stats["x"]["compute_time"],
+        "bytes": 0,
+    }
+    assert second.stats["x"]["misses"] == 2
+    first.invalidate_all_cache()
+    assert budget.total_bytes == 400
+
+
+def stockPortfolio(**kwargs):
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=100, **kwargs)
+    portfolio_.addAsset(
+        name="FakeCompany",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.1,
+        std=0.2,
+        initialValue=100,
+    )
+    portfolio_.addInstrument(
+        assetName="FakeCompany",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.setStrategy(
+        portfolioWeights=[1.0],
+        liquidationFn=strategy.BuyAndHold,
+        cache_liquidations=True,
+        cache_returns=True,
+    )
+    return portfolio_
+
+
+def test_PortfolioCacheStats():
+    budget = cache.CacheBudget()
+    portfolios = []
+    for _ in range(2):
+        portfolio_ = stockPortfolio(cache_budget=budget)
+        portfolio_.simulatePnL()
+        portfolio_.simulatePnL()
+        portfolios.append(portfolio_)
+    report = portfolios[0].cacheStatsReport()
+    assert report.loc[("portfolio", ASSET_CACHE_KEY), "hits"] == 1
+    assert report.loc[("portfolio", ASSET_CACHE_KEY), "misses"] == 1
+    assert budget.total_bytes == 2 * report["bytes"].sum()
+
+
+def test_VersionedCacheKeys():
+    portfolio_ = stockPortfolio()
+    cachedPnL = portfolio_.simulatePnL()
+    portfolio_.simulatePnL()
+    stats = portfolio_.strategy.calculationsCache.stats
+    assert stats[EFFECTIVE_RETURNS_CACHE_KEY]["hits"] == 1
+
+    stock = portfolio_.instruments["Stock_FakeCompany"]
+    with torch.no_grad():
+        stock.price.mul_(2)
+    # Buy and hold: all profit is realized in the last period
+    assert utils.check_equality(
+        portfolio_.simulatePnL()[:, -1], (cachedPnL[:, -1] - 1) / 2
+    )
+    assert stats[EFFECTIVE_RETURNS_CACHE_KEY]["stale"] == 1
+    assert stats[RETURNS_CACHE_KEY]["stale"] == 1
+    assert stats[LIQUIDATIONS_CACHE_KEY]["stale"] == 0
+
+    simulation = portfolio_.assets["FakeCompany"].monteCarloSimulation
+    with torch.no_grad():
+        portfolio_.assets["FakeCompany"].params["std"].mul_(2)
+    portfolio_.simulatePnL()
+    assert portfolio_.assets["FakeCompany"].monteCarloSimulation is not simulation
+    assert stats[LIQUIDATIONS_CACHE_KEY]["stale"] == 1
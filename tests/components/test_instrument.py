@@ -101,3 +101,45 @@ def test_allInstruments():
     assert instrument3.revenue[testAsset.monteCarloSimulation > 100].sum() == 0
     assert instrument5.revenue[testAsset.monteCarloSimulation < 100].sum() > 0
     assert instrument5.revenue[testAsset.monteCarloSimulation > 100].sum() == 0
+
+
+def test_vectorizedPayoffs():
+    testAsset = asset.Asset(
+        "testStock",
+        asset.CompanyValueNormalDistributionProcess,
+        10,
+        1000,
+        mean=0.065,
+        std=0.2,
+        initialValue=100,
+    )
+    payoffFns = [
+        instrument.NonDerivativePayout,
+        instrument.NonDerivativePayoutShort,
+        instrument.EuropeanCallPayout,
+        instrument.EuropeanPutPayout,
+        instrument.AmericanCallPayout,
+        instrument.AmericanPutPayout,
+        instrument.OneTimeComissionDecorator(1, instrument.AmericanPutPayout),
+    ]
+    for payoffFn in payoffFns:
+        assert hasattr(payoffFn, "vectorized")
+        for maturity in [5, 10, 12]:
+            vectorized, legacy = [
+                instrument.Instrument(
+                    name="testInstrument",
+                    assetName="testStock",
+                    assetSimulation=testAsset.monteCarloSimulation,
+                    payoffFn=fn,
+                    price=1,
+                    strikePrice=100,
+                    maturity=maturity,
+                ).revenue
+                for fn in [payoffFn, lambda X, t, params: payoffFn(X, t, params)]
+            ]
+            assert vectorized.shape == legacy.shape
+            assert (vectorized == legacy).all()
+            assert (
+                vectorized.untyped_storage().data_ptr()
+                != testAsset.monteCarloSimulation.untyped_storage().data_ptr()
+            )
@@ -6,9 +6,12 @@ from tofina.components import (
     optimizer,
     portfolio,
     logger,
+    metrics,
 )
 import tofina.utils as utils
 import pandas as pd
+import pytest
+import torch
 
 
 def test_integration():
@@ -97,3 +100,271 @@ def test_integration():
 
     test = pd.read_csv("./tests/results/testOptimizerIntegration.csv")
     assert len(test) > 0
+
+
+def stockBondPortfolio(liquidationFn=strategy.UniformLiquidation, **kwargs):
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=1000, **kwargs)
+    portfolio_.addAsset(
+        name="FakeCompany",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.1,
+        std=0.2,
+        initialValue=100,
+    )
+    portfolio_.addAsset(
+        name="FakeGovernmentObligation",
+        processFn=asset.GovernmentObligtaionProcess,
+        initialValue=100,
+        interestRate=0.05,
+    )
+    portfolio_.addInstrument(
+        assetName="FakeCompany",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.addInstrument(
+        assetName="FakeGovernmentObligation",
+        name="Bond",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.setStrategy(
+        portfolioWeights=[0.5, 0.5],
+        liquidationFn=liquidationFn,
+    )
+    return portfolio_
+
+
+def crraPreference():
+    return preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityCRRA,
+        timeDiscountFn=preference.InterestRateTimeDiscount,
+        interestRate=0.01,
+        RiskAversion=3.0,
+    )
+
+
+def test_reducedProblem():
+    results = []
+    for reduceProblem in [True, False]:
+        portfolio_ = stockBondPortfolio()
+        portfolioOptimizer = optimizer.Optimizer(
+            portfolio=portfolio_,
+            preference=crraPreference(),
+        )
+        portfolioOptimizer.registerLoss(
+            lossTargets=["utility"],
+            lossFn=optimizer.PortfolioOptimizationLoss,
+        )
+        assert portfolioOptimizer.canReduceProblem(
+            ["portfolio.strategy.portfolioWeights"]
+        )
+        results.append(
+            portfolioOptimizer.optimize(
+                paramsToOptimize=["portfolio.strategy.portfolioWeights"],
+                iterations=200,
+                reduceProblem=reduceProblem,
+            )
+        )
+        results[-1]["weights"] = portfolio_.strategy.normalizedWeights.detach()
+    assert abs(results[0]["final_loss"] - results[1]["final_loss"]) < 1e-5
+    assert utils.check_equality(results[0]["weights"], results[1]["weights"])
+
+
+def test_streamedUtility():
+    portfolio_ = stockBondPortfolio(chunkSize=300)
+    assert portfolio_.chunkTrials() == [300, 300, 300, 100]
+    utility = crraPreference()
+    portfolioOptimizer = optimizer.Optimizer(portfolio=portfolio_, preference=utility)
+    portfolioOptimizer.registerLoss(
+        lossTargets=["utility"],
+        lossFn=optimizer.UtilityEqualizationLoss,
+        targetUtility=1.0,
+    )
+    weights = portfolio_.strategy.portfolioWeights
+    weights.requires_grad = True
+
+    loss, _ = portfolioOptimizer.calculateAndLogLoss()
+    loss.backward()
+    portfolioOptimizer.backwardStreamedUtility()
+    streamedGrad = weights.grad.clone()
+    weights.grad = None
+
+    revenue = portfolio_.simulatePnL()
+    assert revenue.shape[0] == 1000
+    assert portfolioOptimizer.profits.shape[0] == 1000
+    assert utils.check_equality(revenue, portfolioOptimizer.revenue)
+    fullUtility = utility.utility(revenue)
+    assert utils.check_equality(fullUtility, portfolioOptimizer.utility)
+    optimizer.UtilityEqualizationLoss(fullUtility, portfolioOptimizer.params).backward()
+    assert utils.check_equality(streamedGrad, weights.grad)
+
+
+def test_streamedRevenueMetric():
+    portfolio_ = stockBondPortfolio(chunkSize=300)
+    portfolioOptimizer = optimizer.Optimizer(
+        portfolio=portfolio_, preference=crraPreference()
+    )
+    portfolioOptimizer.registerLoss(
+        lossTargets=["utility"], lossFn=optimizer.PortfolioOptimizationLoss
+    )
+    portfolioOptimizer.registerMetric(
+        "finalRevenue", ["revenue"], lambda revenue, params: revenue[:, -1].mean()
+    )
+    result = portfolioOptimizer.optimize(
+        [optimizer.WEIGHTS_TARGET], iterations=3, stop=False
+    )
+    assert "final_finalRevenue" in result
+    expected = portfolio_.simulatePnL()[:, -1].mean()
+    assert abs(result["final_finalRevenue"] - expected) < 1e-4
+
+
+def test_compiledPipeline():
+    results = []
+    for compiled in [False, True]:
+        portfolio_ = stockBondPortfolio()
+        portfolioOptimizer = optimizer.Optimizer(
+            portfolio=portfolio_, preference=crraPreference(), compiled=compiled
+        )
+        weights = portfolio_.strategy.portfolioWeights
+        weights.requires_grad = True
+        portfolioOptimizer.calculateUtility()
+        portfolioOptimizer.utility.backward()
+        assert portfolioOptimizer.compiled == compiled
+        results.append(
+            (portfolioOptimizer.utility, portfolioOptimizer.revenue, weights.grad)
+        )
+    for eager, compiled in zip(*results):
+        assert utils.check_equality(eager, compiled)
+
+    portfolioOptimizer = optimizer.Optimizer(
+        portfolio=stockBondPortfolio(),
+        preference=crraPreference(),
+        compiled=True,
+        compileBackend="missingBackend",
+    )
+    assert not portfolioOptimizer.compiled
+    assert utils.check_equality(portfolioOptimizer.utility, results[0][0])
+
+
+def test_batchedCandidates():
+    candidates = torch.tensor([[0.5, 0.5], [1.0, 0.0], [0.2, -0.8], [0.1, 3.0]])
+    metrics_ = {
+        "percentile": metrics.profitPercentile(0.05),
+        "sharpe": metrics.SharpeRatio(0.01),
+        "scenarios": metrics.ScenarioCount(),
+    }
+    for chunkSize in [None, 300]:
+        portfolio_ = stockBondPortfolio(chunkSize=chunkSize)
+        utility = crraPreference()
+        portfolioOptimizer = optimizer.Optimizer(
+            portfolio=portfolio_, preference=utility
+        )
+        batched = portfolioOptimizer.evaluateCandidates(candidates, metrics_)
+        assert batched["revenue"].shape[:2] == (4, 1000)
+        for index, weights in enumerate(candidates):
+            portfolio_.setPortfolioWeights(weights)
+            revenue = portfolio_.simulatePnL()
+            profits = revenue.sum(axis=1)
+            assert utils.check_equality(batched["revenue"][index], revenue)
+            assert utils.check_equality(
+                batched["utility"][index], utility.utility(revenue)
+            )
+            for name, metricFn in metrics_.items():
+                assert utils.check_equality(
+                    batched[name][index], torch.as_tensor(metricFn(profits))
+                )
+
+
+def riskAversionPreference(RiskAversion):
+    return preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityCRRA,
+        timeDiscountFn=preference.InterestRateTimeDiscount,
+        interestRate=0.01,
+        RiskAversion=RiskAversion,
+    )
+
+
+def test_riskAversionFrontier():
+    levels = [0.5, 3.0, 8.0]
+    revenue = stockBondPortfolio().simulatePnL()
+    vectorUtility = riskAversionPreference(levels).utility(revenue)
+    assert vectorUtility.shape == (3,)
+    for level, utility in zip(levels, vectorUtility):
+        assert utils.check_equality(
+            riskAversionPreference(level).utility(revenue), utility
+        )
+
+    def optimizeWeights(RiskAversion, weights, **kwargs):
+        portfolio_ = stockBondPortfolio()
+        portfolio_.setPortfolioWeights(weights)
+        portfolioOptimizer = optimizer.Optimizer(
+            portfolio=portfolio_, preference=riskAversionPreference(RiskAversion)
+        )
+        portfolioOptimizer.registerLoss(
+            lossTargets=["utility"],
+            lossFn=optimizer.PortfolioOptimizationLoss,
+        )
+        portfolioOptimizer.optimize(
+            paramsToOptimize=["portfolio.strategy.portfolioWeights"], **kwargs
+        )
+        return portfolioOptimizer
+
+    # Levels stop early independently, each as it would on its own
+    for kwargs in [
+        {"iterations": 50, "stop": False},
+        {"iterations": 300, "earlyStoppingTolerance": 1e-4},
+    ]:
+        frontier = optimizeWeights(levels, torch.full((3, 2), 0.5), **kwargs)
+        assert frontier.optimizesFrontier()
+        assert frontier.utility.shape == (3,)
+        for index, level in enumerate(levels):
+            single = optimizeWeights(level, torch.tensor([0.5, 0.5]), **kwargs)
+            assert utils.check_equality(
+                frontier.portfolio.strategy.normalizedWeights[index],
+                single.portfolio.strategy.normalizedWeights,
+            )
+            assert utils.check_equality(frontier.utility[index], single.utility)
+            assert (
+                frontier.optimizationResult["convergedLevels"][index]
+                == single.optimizationResult["converged"]
+            )
+
+    # Several levels need one row of weights per level
+    with pytest.raises(ValueError):
+        optimizeWeights(levels, torch.tensor([0.5, 0.5]))
+    with pytest.raises(ValueError):
+        optimizeWeights(levels, torch.full((2, 2), 0.5))
+    with pytest.raises(ValueError):
+        riskAversionPreference(levels).frontierUtility(revenue.expand(2, -1, -1))
+
+
+def test_compiledTargets():
+    portfolioOptimizer = optimizer.Optimizer(
+        portfolio=stockBondPortfolio(), preference=crraPreference()
+    )
+    assert portfolioOptimizer.targetRegistry is None
+    lossTargets = portfolioOptimizer.availableLossTargets
+    assert "portfolio.strategy.portfolioWeights" in lossTargets
+    assert (
+        "portfolio.strategy.portfolioWeights"
+        in portfolioOptimizer.availableOptimizationTargets
+    )
+    for target in lossTargets:
+        portfolioOptimizer.resolveTarget(target)
+    assert (
+        portfolioOptimizer.resolveTarget("preference.params['RiskAversion']")
+        is portfolioOptimizer.preference.params["RiskAversion"]
+    )
+    accessor = optimizer.compileTarget("x[(1, 'a')].y")
+    obj = type("Obj", (), {})()
+    obj.x = {(1, "a"): pd.Series({"y": 2.0})}
+    assert accessor(obj) == 2.0
+
+
+def test_batchedEarlyStopping():
+    earlyStop = optimizer.BatchedEarlyStopping(2, patience=2, tol=0.1)
+    assert not earlyStop(torch.tensor([1.0, 1.0])).any()
+    assert not earlyStop(torch.tensor([0.5, 0.95])).any()
+    assert earlyStop(torch.tensor([0.2, 0.95])).tolist() == [False, True]
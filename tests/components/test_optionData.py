@@ -0,0 +1,42 @@
+from tofina.components import optionData
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+OPTIONS_CSV = """Date,Expiry Date,Call Last,Call Bid,Call Ask,Put Last,Put Bid,Put Ask,Strike Price,Underlying Price
+ 2023-01-04, 2023-01-06,5.0,4.9,5.1,0.1,0.0,0.2,100.0,105.0
+ 2023-01-03, 2023-01-06,6.0,5.9,6.1,0.2,0.1,0.3,100.0,106.0
+ 2023-01-03, 2023-01-13,8.0,7.9,8.1,1.2,1.1,1.3,100.0,106.0
+ 2023-01-05, 2023-01-13,4.0,3.9,4.1,2.2,2.1,2.3,100.0,104.0
+"""
+
+
+def test_OptionDataCache():
+    directory = Path("./tests/results/optionData")
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir()
+    csvPath = directory / "options.csv"
+    csvPath.write_text(OPTIONS_CSV)
+
+    df = optionData.loadOptionData(csvPath, "2023-01-03", "2023-01-05")
+    assert df["Date"].dtype == "datetime64[ns]"
+    assert df["Strike Price"].dtype == np.float64
+    assert df["Date"].tolist() == list(
+        pd.to_datetime(["2023-01-03", "2023-01-03", "2023-01-04"])
+    )
+    assert df["Call Ask"].tolist() == [6.1, 8.1, 5.1]
+    assert df["Expiry Date"][1] == pd.Timestamp("2023-01-13")
+
+    cacheDirectory = directory / ".optionDataCache"
+    assert len(list(cacheDirectory.iterdir())) == 1
+    pd.testing.assert_frame_equal(
+        optionData.loadOptionData(csvPath, "2023-01-03", "2023-01-05"), df
+    )
+    assert len(optionData.loadOptionData(csvPath)) == 4
+    assert len(list(cacheDirectory.iterdir())) == 1
+
+    # Edited CSVs are parsed again
+    csvPath.write_text(OPTIONS_CSV.replace("8.1", "9.1"))
+    df = optionData.loadOptionData(csvPath, start="2023-01-03", end="2023-01-04")
+    assert df["Call Ask"].tolist() == [6.1, 9.1]
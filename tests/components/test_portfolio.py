@@ -1,4 +1,8 @@
 from tofina.components import asset, instrument, strategy, portfolio
+import copy
+import pytest
+import torch
+import warnings
 from tofina import utils
 
 
@@ -105,3 +109,274 @@ def test_ShortInstrument():
     portfolio_.simulatePnL()
     payout_long = portfolio_.instruments["Stock_FakeCompany"].revenue.mean(axis=0)
     assert utils.check_equality(payout_short, 100 + (100 - payout_long))
+
+
+def test_OptionChain():
+    chainPortfolio, singlePortfolio = [
+        portfolio.Portfolio(processLength=10, monteCarloTrials=1000) for _ in range(2)
+    ]
+    strikePrices = [90, 100, 110, 100]
+    maturities = [5, 5, 8, 12]
+    isCall = [True, False, True, False]
+    prices = [12, 5, 6, 8]
+    for portfolio_ in [chainPortfolio, singlePortfolio]:
+        portfolio_.addAsset(
+            name="FakeCompany",
+            processFn=asset.CompanyValueNormalDistributionProcess,
+            mean=0.1,
+            std=0.2,
+            initialValue=100,
+        )
+    chain = chainPortfolio.addOptionChain(
+        "FakeCompany", "Option", strikePrices, maturities, isCall, prices
+    )
+    for strike, maturity, call, price in zip(strikePrices, maturities, isCall, prices):
+        singlePortfolio.addInstrument(
+            assetName="FakeCompany",
+            name="Option" + ("_Call_" if call else "_Put_") + f"{strike}_{maturity}",
+            payoffFn=(
+                instrument.AmericanCallPayout if call else instrument.AmericanPutPayout
+            ),
+            price=price,
+            strikePrice=strike,
+            maturity=maturity,
+        )
+    assert list(chainPortfolio.instruments) == list(singlePortfolio.instruments)
+    assert chain.revenue.shape == (4, 1000, 10)
+    assert (chainPortfolio.instrumentX == singlePortfolio.instrumentX).all()
+
+    for portfolio_ in [chainPortfolio, singlePortfolio]:
+        portfolio_.setStrategy(
+            portfolioWeights=[0.25, 0.25, 0.25, 0.25],
+            liquidationFn=strategy.BuyAndHold,
+        )
+    assert utils.check_equality(
+        chainPortfolio.simulatePnL(), singlePortfolio.simulatePnL()
+    )
+
+    calculateProfit = chain.calculateProfit
+    calls = []
+    chain.calculateProfit = lambda: calls.append(1) or calculateProfit()
+    chainPortfolio.regenerateAllAssetsAndInstruments(monteCarloTrials=10)
+    assert len(calls) == 0
+    assert chain.revenue.shape == (4, 10, 10)
+    assert chainPortfolio.instrumentX.shape == (4, 10, 10)
+    assert len(calls) == 1
+
+
+def test_OptionChainContractParams():
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=1000)
+    portfolio_.addAsset(
+        name="FakeCompany",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.1,
+        std=0.2,
+        initialValue=100,
+    )
+    chain = portfolio_.addOptionChain(
+        "FakeCompany", "Option", [90, 110], [5, 8], [True, True], [12, 6]
+    )
+    portfolio_.setStrategy(
+        portfolioWeights=[0.5, 0.5],
+        liquidationFn=strategy.BuyAndHold,
+        cache_liquidations=True,
+    )
+    contract = chain.contracts[1]
+    assert isinstance(contract, instrument.Instrument)
+    assert contract.arena is None and contract.cachedRevenue is None
+    with pytest.raises(TypeError):
+        contract.params["strikePrice"] = 100
+    portfolio_.simulatePnL()
+    # Revenue periods start after the purchase, maturity 8 is liquidated at 6
+    liquidations = portfolio_.strategy.liquidations(portfolio_.assetX)
+    assert liquidations[0, :, 1].argmax() == 6
+
+    with torch.no_grad():
+        contract.params["strikePrice"].fill_(100)
+        contract.params["maturity"].fill_(4)
+    assert chain.strikePrices.tolist() == [90, 100]
+    assert chain.maturities.tolist() == [5, 4]
+    simulation = portfolio_.getMonteCarloSimulation("FakeCompany")
+    expected = instrument.AmericanCallPayoutVectorized(
+        simulation, {"strikePrice": 100, "maturity": 4}
+    )
+    assert (contract.revenue == expected).all()
+    liquidations = portfolio_.strategy.liquidations(portfolio_.assetX)
+    assert liquidations[0, :, 1].argmax() == 2
+
+    chain.strikePrices = [80, 120]
+    assert contract.params["strikePrice"] == 120
+    assert copy.deepcopy(contract.params)["strikePrice"] == 120
+
+
+def test_LazyDependencyGraph():
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=1000)
+    for name in ["FakeCompany", "OtherCompany"]:
+        portfolio_.addAsset(
+            name=name,
+            processFn=asset.CompanyValueNormalDistributionProcess,
+            mean=0.1,
+            std=0.2,
+            initialValue=100,
+        )
+        for strike in [90, 100, 110]:
+            portfolio_.addInstrument(
+                assetName=name,
+                name="Call" + str(strike),
+                payoffFn=instrument.EuropeanCallPayout,
+                price=10,
+                strikePrice=strike,
+                maturity=10,
+            )
+    assert all(
+        instrument_.cachedRevenue is None
+        for instrument_ in portfolio_.instruments.values()
+    )
+    portfolio_.setStrategy(
+        portfolioWeights=[1.0] * 6,
+        liquidationFn=strategy.BuyAndHold,
+        cache_liquidations=True,
+        cache_returns=True,
+    )
+    portfolio_.simulatePnL()
+
+    calls = []
+    for asset_ in portfolio_.assets.values():
+        simulate = asset_.simulate
+        asset_.simulate = lambda simulate=simulate, name=asset_.name: (
+            calls.append(name) or simulate()
+        )
+    for name, instrument_ in portfolio_.instruments.items():
+        calculateProfit = instrument_.calculateProfit
+        instrument_.calculateProfit = lambda fn=calculateProfit, name=name: (
+            calls.append(name) or fn()
+        )
+    portfolio_.simulatePnL()
+    assert calls == []
+
+    with torch.no_grad():
+        portfolio_.assets["OtherCompany"].params["std"].mul_(2)
+    portfolio_.simulatePnL()
+    assert sorted(calls) == [
+        "Call100_OtherCompany",
+        "Call110_OtherCompany",
+        "Call90_OtherCompany",
+        "OtherCompany",
+    ]
+
+
+def test_InstrumentArena():
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=1000)
+    portfolio_.addAsset(
+        name="FakeCompany",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.1,
+        std=0.2,
+        initialValue=100,
+    )
+    for strike in [90, 100, 110]:
+        portfolio_.addInstrument(
+            assetName="FakeCompany",
+            name="Call" + str(strike),
+            payoffFn=instrument.EuropeanCallPayout,
+            price=10,
+            strikePrice=strike,
+            maturity=10,
+        )
+    instrumentX = portfolio_.instrumentX
+    for index, instrument_ in enumerate(portfolio_.instruments.values()):
+        assert instrument_.revenue.data_ptr() == instrumentX[index].data_ptr()
+    expected = torch.stack(
+        [
+            instrument_.calculateProfit()
+            for instrument_ in portfolio_.instruments.values()
+        ]
+    )
+    assert (instrumentX == expected).all()
+
+    assetX = portfolio_.assetX
+    revenue = portfolio_.instruments["Call100_FakeCompany"].revenue
+    assetValues, revenueValues = assetX.clone(), revenue.clone()
+    with torch.no_grad():
+        portfolio_.assets["FakeCompany"].params["std"].mul_(2)
+    portfolio_.refresh()
+    # Earlier results are not overwritten by the new simulation
+    assert portfolio_.instrumentX is not instrumentX
+    assert (instrumentX == expected).all()
+    assert not (portfolio_.instrumentX == expected).all()
+    assert portfolio_.assetX is not assetX
+    assert (assetX == assetValues).all()
+    assert (revenue == revenueValues).all()
+    assert portfolio_.assetX is portfolio_.assetArena.buffer
+    for index, instrument_ in enumerate(portfolio_.instruments.values()):
+        assert (
+            instrument_.revenue.data_ptr() == portfolio_.instrumentX[index].data_ptr()
+        )
+    assert portfolio_.assetArena.slots == 1
+    assert portfolio_.instrumentArena.slots == 3
+    with pytest.raises(ValueError):
+        portfolio_.instrumentArena.gather([revenue])
+
+
+def test_AssetIndex():
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=100)
+    names = ["A", "B", "C"]
+    portfolio_.addAsset(
+        name=names,
+        processFn=asset.CompanyValueMultiNormalDistributionProcess,
+        mean=torch.tensor([0.05, 0.06, 0.07]),
+        covarianceMatrix=torch.eye(3) * 0.01,
+        initialValue=torch.tensor([100.0, 100.0, 100.0]),
+    )
+    portfolio_.addAsset(
+        name="Bond",
+        processFn=asset.GovernmentObligtaionProcess,
+        initialValue=100,
+        interestRate=0.05,
+    )
+    group = portfolio_.assets[tuple(names)].monteCarloSimulation
+    for position, name in enumerate(names):
+        assert torch.equal(portfolio_.getMonteCarloSimulation(name), group[position])
+    assert portfolio_.getMonteCarloSimulation(tuple(names)) is group
+    try:
+        portfolio_.getMonteCarloSimulation("D")
+        assert False
+    except ValueError:
+        pass
+
+    for name in names + ["Bond"]:
+        portfolio_.addInstrument(
+            assetName=name,
+            name="Stock",
+            payoffFn=instrument.NonDerivativePayout,
+            price=100,
+        )
+    assert list(portfolio_.instrumentIds.values()) == [0, 1, 2, 3]
+    assert list(portfolio_.instrumentIds) == list(portfolio_.instruments)
+    instrumentX = portfolio_.instrumentX
+    assert torch.equal(instrumentX[portfolio_.instrumentIds["Stock_B"]], group[1])
+
+
+def test_PortfolioSamplingMode():
+    for sampling in ["antithetic", "sobol"]:
+        portfolio_ = portfolio.Portfolio(
+            processLength=10, monteCarloTrials=1000, sampling=sampling
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            portfolio_.addAsset(
+                name="FakeCompany",
+                processFn=asset.CompanyValueNormalDistributionProcess,
+                mean=0.1,
+                std=0.2,
+                initialValue=100,
+            )
+            portfolio_.addAsset(
+                name="FakeGovernmentObligation",
+                processFn=asset.GovernmentObligtaionProcess,
+                initialValue=100,
+                interestRate=0.05,
+            )
+        assert portfolio_.assets["FakeGovernmentObligation"].sampling == sampling
+        bond = portfolio_.getMonteCarloSimulation("FakeGovernmentObligation")
+        assert (bond == bond[0]).all()
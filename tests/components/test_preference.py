@@ -1,4 +1,6 @@
 from tofina.components import asset, instrument, strategy, preference, portfolio
+import math
+import torch
 from tofina import utils
 
 
@@ -54,3 +56,126 @@ def test_SimplePreference():
         RiskAversion=0.5,
     )
     assert utils.check_equality(utility.utility(profit), profit[:, -1].mean())
+
+
+def test_ControlVariates():
+    portfolio_ = portfolio.Portfolio(processLength=10, monteCarloTrials=1000)
+    portfolio_.addAsset(
+        name="FakeCompany",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.1,
+        std=0.2,
+        initialValue=100,
+    )
+    portfolio_.addAsset(
+        name="FakeGovernmentObligation",
+        processFn=asset.GovernmentObligtaionProcess,
+        initialValue=100,
+        interestRate=0.05,
+    )
+    portfolio_.addInstrument(
+        assetName="FakeCompany",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.addInstrument(
+        assetName="FakeGovernmentObligation",
+        name="Bond",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.setStrategy(
+        portfolioWeights=[0.6, 0.4],
+        liquidationFn=strategy.BuyAndHold,
+    )
+    controls = portfolio_.controlVariates()
+    assert controls.shape == (1000, 9)
+
+    profit = portfolio_.simulatePnL()
+    utility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityRiskNeutral,
+        timeDiscountFn=preference.NoTimeDiscount,
+    )
+    # Profit of a stock and bond portfolio is linear in the controls,
+    # so the control variate estimator recovers the exact expectation
+    expectedProfit = 0.6 * (1.1**9 - 1) + 0.4 * (1.05**9 - 1)
+    assert utils.check_equality(utility.utility(profit, controls), expectedProfit)
+    assert not utils.check_equality(utility.utility(profit), expectedProfit)
+
+
+def test_ControlVariatesFewTrials():
+    portfolio_ = portfolio.Portfolio(processLength=20, monteCarloTrials=60)
+    for name in ["A", "B", "C"]:
+        portfolio_.addAsset(
+            name=name,
+            processFn=asset.CompanyValueNormalDistributionProcess,
+            mean=0.1,
+            std=0.2,
+            initialValue=100,
+        )
+        portfolio_.addInstrument(
+            assetName=name,
+            name="Stock",
+            payoffFn=instrument.NonDerivativePayout,
+            price=100,
+        )
+    portfolio_.setStrategy(
+        portfolioWeights=[1 / 3, 1 / 3, 1 / 3],
+        liquidationFn=strategy.BuyAndHold,
+    )
+    # 57 candidate controls on 60 trials are capped to the latest periods
+    controls = portfolio_.controlVariates()
+    assert controls.shape == (60, 6)
+    finalValues = torch.stack(
+        [portfolio_.getMonteCarloSimulation(name)[:, -1] for name in "ABC"], dim=1
+    )
+    assert utils.check_equality(controls[:, :3], finalValues - 100 * 1.1**19)
+
+    # Too many controls fall back to the plain estimate
+    profit = portfolio_.simulatePnL()
+    manyControls = torch.randn(60, 10)
+    assert (utils.controlVariateAdjustment(profit, manyControls) == profit).all()
+    utility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityRiskNeutral,
+        timeDiscountFn=preference.NoTimeDiscount,
+    )
+    assert utility.utility(profit, manyControls) == utility.utility(profit)
+
+
+def test_TimeDiscounts():
+    utility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityRiskNeutral,
+        timeDiscountFn=preference.InterestRateTimeDiscount,
+        interestRate=[0.01, 0.05],
+    )
+    timeDiscounts = utility.timeDiscounts(9)
+    assert timeDiscounts.shape == (9, 2)
+    assert utils.check_equality(timeDiscounts[:, 1], 1.05 ** -torch.arange(1.0, 10))
+    assert utility.timeDiscounts(9) is timeDiscounts
+    with torch.no_grad():
+        utility.params["interestRate"][0] = 0.05
+    assert utils.check_equality(utility.timeDiscounts(9)[:, 0], timeDiscounts[:, 1])
+
+    # Discount functions of a single integer period still work
+    def ExponentialTimeDiscount(time, params):
+        return math.exp(-float(params["interestRate"]) * time)
+
+    scalarUtility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityRiskNeutral,
+        timeDiscountFn=ExponentialTimeDiscount,
+        interestRate=0.05,
+    )
+    assert utils.check_equality(
+        scalarUtility.timeDiscounts(9), torch.exp(-0.05 * torch.arange(1.0, 10))
+    )
+
+    interestRate = utility.params["interestRate"]
+    interestRate.requires_grad = True
+    for _ in range(2):
+        interestRate.grad = None
+        utility.utility(torch.ones(5, 9)).sum().backward()
+        assert utils.check_equality(
+            interestRate.grad,
+            -(torch.arange(1.0, 10) / 1.05 ** torch.arange(2.0, 11)).sum(),
+        )
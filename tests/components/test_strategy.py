@@ -1,5 +1,6 @@
 from tofina.components import asset, instrument, portfolio, strategy
 import torch
+from tofina import utils
 
 
 def test_autoExcerciseAmericanOption():
@@ -100,3 +101,141 @@ def test_autoExcerciseEuropeanOption2():
     )
     profit = portfolio_.simulatePnL()
     assert profit.sum() < 0
+
+
+def test_structuredLiquidationSchedule():
+    portfolio_ = portfolio.Portfolio(10, 1000)
+    portfolio_.addAsset(
+        name="testStock",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.065,
+        std=0.2,
+        initialValue=100,
+    )
+    portfolio_.addInstrument(
+        assetName="testStock",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    for maturity in [3, 7, 15]:
+        portfolio_.addInstrument(
+            assetName="testStock",
+            name=f"AmericanCall{maturity}",
+            payoffFn=instrument.AmericanCallPayout,
+            price=1,
+            strikePrice=100,
+            maturity=maturity,
+        )
+
+    def DenseUniformLiquidation(Xt, instruments, params):
+        return strategy.UniformLiquidation(Xt, instruments, params).repeat(
+            1, Xt.shape[-2], 1
+        )
+
+    profits = []
+    for liquidationFn in [strategy.UniformLiquidation, DenseUniformLiquidation]:
+        portfolio_.setStrategy(
+            portfolioWeights=[0.25, 0.25, 0.25, 0.25],
+            liquidationFn=liquidationFn,
+        )
+        liquidations = portfolio_.strategy.liquidations(portfolio_.assetX)
+        profits.append(portfolio_.simulatePnL())
+
+    assert liquidations.shape == (1000, 9, 4)
+    schedule = strategy.UniformLiquidation(
+        portfolio_.assetX, portfolio_.instruments, {}
+    )
+    assert schedule.shape == (4, 1, 10)
+    # Instruments maturing inside the horizon are fully liquidated at maturity
+    remaining = 1 - liquidations.sum(axis=1)
+    assert (remaining.abs() < 1e-6).all()
+    assert (liquidations[:, 2:, 1] == 0).all()
+    assert (liquidations[:, 6:, 2] == 0).all()
+    assert (liquidations[:, 8, 3] > 0).all()
+    assert utils.check_equality(profits[0], profits[1])
+
+
+def test_fusedProfit():
+    portfolio_ = portfolio.Portfolio(10, 1000)
+    portfolio_.addAsset(
+        name="testStock",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.065,
+        std=0.2,
+        initialValue=100,
+    )
+    portfolio_.addInstrument(
+        assetName="testStock",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    portfolio_.addInstrument(
+        assetName="testStock",
+        name="EuropeanPut",
+        payoffFn=instrument.EuropeanPutPayout,
+        price=10,
+        strikePrice=100,
+        maturity=5,
+    )
+    gradients = []
+    profits = []
+    for cache in [False, True]:
+        portfolio_.setStrategy(
+            portfolioWeights=[0.7, 0.3],
+            liquidationFn=strategy.UniformLiquidation,
+            cache_liquidations=cache,
+            cache_returns=cache,
+        )
+        price = portfolio_.instruments["EuropeanPut_testStock"].price
+        price.requires_grad = True
+        price.grad = None
+        portfolio_.strategy.portfolioWeights.requires_grad = True
+        profit = portfolio_.simulatePnL()
+        profit.mean().backward()
+        profits.append(profit.detach())
+        gradients.append(
+            [price.grad.clone(), portfolio_.strategy.portfolioWeights.grad.clone()]
+        )
+    assert utils.check_equality(profits[0], profits[1])
+    for fused, cached in zip(*gradients):
+        assert utils.check_equality(fused, cached)
+
+
+def test_maturityChange():
+    def optionPortfolio(maturity):
+        portfolio_ = portfolio.Portfolio(10, 100)
+        portfolio_.addAsset(
+            name="testStock",
+            processFn=asset.CompanyValueNormalDistributionProcess,
+            mean=0.065,
+            std=0.2,
+            initialValue=100,
+        )
+        portfolio_.addInstrument(
+            assetName="testStock",
+            name="EuropeanCallInstrument",
+            payoffFn=instrument.EuropeanCallPayout,
+            price=1,
+            strikePrice=100,
+            maturity=maturity,
+        )
+        portfolio_.setStrategy(
+            portfolioWeights=[1],
+            liquidationFn=strategy.BuyAndHold,
+            cache_liquidations=True,
+        )
+        return portfolio_
+
+    portfolio_ = optionPortfolio(8)
+    strategy_ = portfolio_.strategy
+    before = strategy_.liquidations(portfolio_.assetX).clone()
+    with torch.no_grad():
+        portfolio_.instruments["EuropeanCallInstrument_testStock"].params[
+            "maturity"
+        ].fill_(4)
+    after = strategy_.liquidations(portfolio_.assetX)
+    expected = optionPortfolio(4)
+    assert not utils.check_equality(before, after)
+    assert utils.check_equality(after, expected.strategy.liquidations(expected.assetX))
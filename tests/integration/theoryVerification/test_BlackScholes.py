@@ -1,7 +1,8 @@
-from tofina.components import preference
+from tofina.components import asset, instrument, preference
 from tofina.theory import blackScholes
 from tofina.macros import utilityEqualization
 import pandas as pd
+import numpy as np
 
 
 def test_BlackScholesOptionPricingPut():
@@ -66,7 +67,9 @@ def test_BlackScholesOptionPricingCall():
         optionCall=optionCall,
         optionPrice=50,
         initialWeights=[0.5, 0.5, 0],
-        monteCarloTrials=10000,
+        # Discrete normal returns price this call about 1.4 below
+        # Black-Scholes, the bounds are over 4 standard errors from it
+        monteCarloTrials=100000,
     )
     utilityEqualization.DerivativePricing(
         zeroDerivativePortfolio,
@@ -124,3 +127,35 @@ def test_BlackScholesImpliedVolatility():
         iterations=500,
         lr=0.1,
     )
+
+
+def monteCarloCallPrice(monteCarloTrials, sampling, seed, S=100, K=120, T=10):
+    company = asset.Asset(
+        "Company",
+        asset.CompanyValueNormalDistributionProcess,
+        T + 1,
+        monteCarloTrials,
+        seed=seed,
+        sampling=sampling,
+        mean=0.0,
+        std=0.2,
+        initialValue=S,
+    )
+    option = instrument.Instrument(
+        name="EuropeanOption",
+        assetName="Company",
+        assetSimulation=company.monteCarloSimulation,
+        payoffFn=instrument.EuropeanCallPayout,
+        price=0,
+        strikePrice=K,
+        maturity=T + 1,
+    )
+    return float(option.revenue[:, T].mean())
+
+
+def test_BlackScholesSobolSampling():
+    target = blackScholes.BlackScholesOptionPricing(100, 120, 10, 0.0, 0.2, True)
+    pseudoPrices = [monteCarloCallPrice(10000, "pseudo", seed) for seed in range(10)]
+    sobolPrices = [monteCarloCallPrice(1024, "sobol", seed) for seed in range(10)]
+    assert np.abs(np.mean(sobolPrices) - target) < 1
+    assert np.std(sobolPrices) < np.std(pseudoPrices)
@@ -1,4 +1,4 @@
-from tofina.components import asset, preference
+from tofina.components import asset, instrument, preference
 from tofina.theory import binomial
 import tofina.utils as utils
 from tofina.macros import portfolioOptimization, utilityEqualization
@@ -169,6 +169,54 @@ def test_MultiPeriodOptionPricingCall():
     assert optimizationLog["EuropeanOption_Company"].iloc[-1] < target + 1
 
 
+def monteCarloBinomialCallPrice(monteCarloTrials, sampling, seed, maturity=9):
+    theory = binomial.BinomialMultiPeriodTheory()
+    company = asset.Asset(
+        "Company",
+        asset.CompanyValueBinomialProcess,
+        maturity + 1,
+        monteCarloTrials,
+        seed=seed,
+        sampling=sampling,
+        S0=100,
+        u=theory.u,
+        d=theory.d,
+        qU=theory.qU,
+    )
+    option = instrument.Instrument(
+        name="EuropeanOption",
+        assetName="Company",
+        assetSimulation=company.monteCarloSimulation,
+        payoffFn=instrument.EuropeanCallPayout,
+        price=0,
+        strikePrice=170,
+        maturity=maturity + 1,
+    )
+    return float(option.revenue[:, maturity].mean()) / (1 + theory.R) ** maturity
+
+
+def test_SobolSamplingError():
+    target = (
+        binomial.BinomialMultiPeriodTheory().priceEuropeanOption(
+            maturity=9, call=True, strikePrice=1.7
+        )
+        * 100
+    )
+
+    def rootMeanSquaredError(monteCarloTrials, sampling):
+        errors = [
+            monteCarloBinomialCallPrice(monteCarloTrials, sampling, seed) - target
+            for seed in range(10)
+        ]
+        return np.sqrt(np.mean(np.square(errors)))
+
+    pseudoError = rootMeanSquaredError(10000, "pseudo")
+    sobolError = rootMeanSquaredError(1024, "sobol")
+    antitheticError = rootMeanSquaredError(10000, "antithetic")
+    assert sobolError < pseudoError
+    assert antitheticError < pseudoError
+
+
 def testTheoreticalModels():
     twoPeriod = binomial.BinomialTwoPeriodTheory()
     multiPeriod = binomial.BinomialMultiPeriodTheory()
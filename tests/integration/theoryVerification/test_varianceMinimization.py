@@ -28,27 +28,41 @@ def test_VarianceMinimization():
                 covariance3[i][z] = covariance3[i][z] / 3
 
     mean = 0.03
+    # CRRA optima deviate from the minimum variance portfolio by up to 0.03
+    # at 100000 trials depending on the sample, and by about 0.01 at 1000000.
+    # Early stopping halts before convergence, so every run takes all steps
+    monteCarloTrials = 1000000
+    optimizationParams = {"iterations": 200, "stop": False}
 
     portfolio_ = varianceMinimization.GenerateVarianceMinimizationPortfolio(
-        mean, covariance1, torch.tensor([1.0, 1.0]), torch.tensor([1.0, 1.0])
+        mean,
+        covariance1,
+        torch.tensor([1.0, 1.0]),
+        torch.tensor([1.0, 1.0]),
+        monteCarloTrials,
     )
     portfolioOptimization.optimizeStockPortfolioRiskAverse(
-        portfolio_, minVarianceFilePath1
+        portfolio_, minVarianceFilePath1, **optimizationParams
     )
     portfolio_ = varianceMinimization.GenerateVarianceMinimizationPortfolio(
-        mean, covariance2, torch.tensor([1.0, 1.0, 1.0]), torch.tensor([1.0, 1.0, 1.0])
+        mean,
+        covariance2,
+        torch.tensor([1.0, 1.0, 1.0]),
+        torch.tensor([1.0, 1.0, 1.0]),
+        monteCarloTrials,
     )
     portfolioOptimization.optimizeStockPortfolioRiskAverse(
-        portfolio_, minVarianceFilePath2
+        portfolio_, minVarianceFilePath2, **optimizationParams
     )
     portfolio_ = varianceMinimization.GenerateVarianceMinimizationPortfolio(
         mean,
         covariance3,
         torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0]),
         torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0]),
+        monteCarloTrials,
     )
     portfolioOptimization.optimizeStockPortfolioRiskAverse(
-        portfolio_, minVarianceFilePath3
+        portfolio_, minVarianceFilePath3, **optimizationParams
     )
 
     theoreticalWeights1 = varianceMinimization.CalculateMinimumVariancePortfolio(
@@ -0,0 +1,90 @@
+import torch
+import tofina.utils as utils
+from typing import List, Optional
+
+
+class Arena:
+    """
+    Preallocated contiguous (slots x ...) buffer. Tensors placed into a slot
+    become views of the buffer, so gathering all slots is the buffer itself
+    and no torch.stack copy is needed. Tensors living outside the arena are
+    copied into their slot only when they were replaced or modified.
+    Tensors tracked by autograd are never written into the buffer, since
+    overwriting it in place would invalidate graphs saved on earlier values.
+    Slots that were handed out are copy-on-write: writing one moves the
+    arena to a fresh copy of the buffer, so tensors returned earlier keep
+    their values. The number of slots is set by the owner of the arena.
+    """
+
+    def __init__(self, slots: int = 0):
+        self.slots = slots
+        self.buffer: Optional[torch.Tensor] = None
+        self.sources = []
+        self.shared = []
+
+    def release(self) -> None:
+        self.buffer = None
+        self.sources = []
+        self.shared = []
+
+    def ensureBuffer(self, slots: int, shape: torch.Size, dtype: torch.dtype) -> None:
+        if (
+            self.buffer is None
+            or self.buffer.shape != (slots, *shape)
+            or self.buffer.dtype != dtype
+        ):
+            self.buffer = torch.empty((slots, *shape), dtype=dtype)
+            self.sources = [None] * slots
+            self.shared = [False] * slots
+
+    def inArena(self, index: int, tensor: torch.Tensor) -> bool:
+        return self.buffer is not None and utils.sameTensorView(
+            tensor, self.buffer[index]
+        )
+
+    def write(self, index: int, tensor: torch.Tensor) -> torch.Tensor:
+        if self.shared[index]:
+            # Sources stay valid, the copy holds the same values
+            self.buffer = self.buffer.clone()
+            self.shared = [False] * self.slots
+        slot = self.buffer[index]
+        slot.copy_(tensor)
+        return slot
+
+    def place(self, index: int, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Writes tensor into slot index and returns the view of the slot.
+        Autograd tracked tensors are returned unchanged.
+        """
+        if torch.is_grad_enabled() and tensor.requires_grad:
+            return tensor
+        if index >= self.slots:
+            return tensor
+        self.ensureBuffer(self.slots, tensor.shape, tensor.dtype)
+        slot = self.write(index, tensor)
+        self.sources[index] = utils.tensorVersions(slot)
+        self.shared[index] = True
+        return slot
+
+    def gather(self, tensors: List[torch.Tensor]) -> torch.Tensor:
+        if len(tensors) != self.slots:
+            raise ValueError(
+                f"Tofina: arena has {self.slots} slots, got {len(tensors)} tensors"
+            )
+        if torch.is_grad_enabled() and any(t.requires_grad for t in tensors):
+            return torch.stack(tensors)
+        dtype = tensors[0].dtype
+        for tensor in tensors[1:]:
+            dtype = torch.promote_types(dtype, tensor.dtype)
+        self.ensureBuffer(self.slots, tensors[0].shape, dtype)
+        for index, tensor in enumerate(tensors):
+            if self.inArena(index, tensor):
+                continue
+            versions = utils.tensorVersions(tensor)
+            source = self.sources[index]
+            if source is not None and utils.versionsMatch(source, versions):
+                continue
+            self.write(index, tensor)
+            self.sources[index] = versions
+        self.shared = [True] * self.slots
+        return self.buffer
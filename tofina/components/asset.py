@@ -1,11 +1,139 @@
 import torch
+import math
+import hashlib
+import inspect
+import warnings
 import tofina.utils as utils
-from torch.distributions.multivariate_normal import MultivariateNormal
-from typing import Callable, Union, List
-import random
-import numpy as np
+from tofina.components import store
+from tofina.constants import (
+    DEFAULT_SEED,
+    PSEUDO_RANDOM_SAMPLING,
+    ANTITHETIC_SAMPLING,
+    SOBOL_SAMPLING,
+)
+from typing import Callable, Mapping, Optional, Union, List
 
 processFnType = Callable[[int, int, dict], torch.Tensor]
+expectationFnType = Callable[[int, dict], torch.Tensor]
+
+
+def streamSeed(seed: int, name: Union[str, tuple], chunkIndex: int) -> int:
+    """
+    Stable seed of an independent random stream for one chunk of one asset.
+    Python's hash() is salted per process, so sha256 is used instead.
+    """
+    key = f"{seed}/{name}/{chunkIndex}".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], "little")
+
+
+def acceptsArgument(processFn: processFnType, argument: str) -> bool:
+    try:
+        return argument in inspect.signature(processFn).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+SAMPLING_MODES = [PSEUDO_RANDOM_SAMPLING, ANTITHETIC_SAMPLING, SOBOL_SAMPLING]
+SOBOL_EPSILON = 1e-7
+
+
+def sobolUniform(
+    monteCarloTrials: int, dimension: int, generator: Optional[torch.Generator]
+) -> torch.Tensor:
+    if dimension > torch.quasirandom.SobolEngine.MAXDIM:
+        raise ValueError(
+            f"Sobol sampling supports at most {torch.quasirandom.SobolEngine.MAXDIM}"
+            " random numbers per trial"
+        )
+    scrambleSeed = int(torch.randint(0, 2**31 - 1, (1,), generator=generator))
+    engine = torch.quasirandom.SobolEngine(dimension, scramble=True, seed=scrambleSeed)
+    return engine.draw(monteCarloTrials).clamp(SOBOL_EPSILON, 1 - SOBOL_EPSILON)
+
+
+def brownianBridgeIncrements(normals: torch.Tensor) -> torch.Tensor:
+    """
+    Turns standard normals (trials x steps [x dims]) into Brownian increments
+    built in Brownian-bridge order: normals[:, 0] fixes the terminal value,
+    the following ones fix midpoints of ever smaller intervals. Low Sobol
+    dimensions are the most uniform, so they end up driving the coarse
+    shape of the path.
+    """
+    steps = normals.shape[1]
+    W = torch.zeros((normals.shape[0], steps + 1) + normals.shape[2:])
+    W[:, steps] = math.sqrt(steps) * normals[:, 0]
+    intervals = [(0, steps)]
+    k = 1
+    while intervals:
+        nextIntervals = []
+        for left, right in intervals:
+            if right - left < 2:
+                continue
+            mid = (left + right) // 2
+            W[:, mid] = ((right - mid) * W[:, left] + (mid - left) * W[:, right]) / (
+                right - left
+            ) + math.sqrt((mid - left) * (right - mid) / (right - left)) * normals[:, k]
+            k += 1
+            nextIntervals += [(left, mid), (mid, right)]
+        intervals = nextIntervals
+    return W[:, 1:] - W[:, :-1]
+
+
+def normalShocks(
+    monteCarloTrials: int,
+    processLength: int,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
+    dims: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Standard normal shocks of shape (trials x processLength [x dims]).
+    Period 0 holds the initial value, so only pseudo random sampling fills
+    column 0 (to keep its historical draws); other modes leave it at zero.
+    """
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"sampling must be one of {SAMPLING_MODES}")
+    trailing = () if dims is None else (dims,)
+    if sampling == PSEUDO_RANDOM_SAMPLING:
+        return torch.randn(
+            (monteCarloTrials, processLength) + trailing, generator=generator
+        )
+
+    steps = processLength - 1
+    if sampling == ANTITHETIC_SAMPLING:
+        half = (monteCarloTrials + 1) // 2
+        normals = torch.randn((half, steps) + trailing, generator=generator)
+        shocks = torch.cat([normals, -normals])[:monteCarloTrials]
+    else:
+        uniform = sobolUniform(monteCarloTrials, steps * (dims or 1), generator)
+        normals = torch.special.ndtri(uniform).reshape(
+            (monteCarloTrials, steps) + trailing
+        )
+        shocks = brownianBridgeIncrements(normals)
+    initial = torch.zeros((monteCarloTrials, 1) + trailing)
+    return torch.cat([initial, shocks], dim=1)
+
+
+def uniformShocks(
+    monteCarloTrials: int,
+    processLength: int,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
+) -> torch.Tensor:
+    """
+    Uniform shocks of shape (trials x processLength), column 0 is unused.
+    """
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"sampling must be one of {SAMPLING_MODES}")
+    steps = processLength - 1
+    if sampling == PSEUDO_RANDOM_SAMPLING:
+        shocks = torch.rand((steps, monteCarloTrials), generator=generator).T
+    elif sampling == ANTITHETIC_SAMPLING:
+        half = (monteCarloTrials + 1) // 2
+        uniform = torch.rand((half, steps), generator=generator)
+        shocks = torch.cat([uniform, 1 - uniform])[:monteCarloTrials]
+    else:
+        shocks = sobolUniform(monteCarloTrials, steps, generator)
+    return torch.cat([torch.zeros((monteCarloTrials, 1)), shocks], dim=1)
 
 
 class Asset:
@@ -22,54 +150,180 @@ class Asset:
         processFn: processFnType,
         processLength: int,
         monteCarloTrials: int,
-        **kwargs
+        seed: int = DEFAULT_SEED,
+        sampling: str = PSEUDO_RANDOM_SAMPLING,
+        simulationStore: Optional[store.SimulationStore] = None,
+        **kwargs,
     ) -> None:
         self.processFn = processFn
         self.processLength = processLength
         self.monteCarloTrials = monteCarloTrials
+        self.seed = seed
+        self.sampling = sampling
+        self.simulationStore = simulationStore
+        if simulationStore is None:
+            self.simulationStore = store.defaultStore()
         self.params = utils.convertKwargsToTorchParameters(kwargs)
-        self.monteCarloSimulation = self.simulate()
-        if len(self.monteCarloSimulation.shape) == 3:
-            assert type(name) is list
-            name = tuple(name)
-        if len(self.monteCarloSimulation.shape) == 2:
-            assert type(name) is str
-        self.name = name
-
-    def setSeed(self, seed: int) -> None:
-        torch.manual_seed(seed)
-        np.random.seed(seed)
-        random.seed(seed)
-
-    def simulate(self, monteCarloTrials=None) -> torch.Tensor:
+        self.name = tuple(name) if type(name) is list else name
+        self.simulatedParams = None
+        self.cachedSimulation = None
+        if sampling not in SAMPLING_MODES:
+            raise ValueError(f"sampling must be one of {SAMPLING_MODES}")
+        # Processes without variance reduction support (e.g. forecasters)
+        # fall back to pseudo-random sampling, so a portfolio-wide sampling
+        # mode never rules out mixing them with supporting processes
+        if sampling != PSEUDO_RANDOM_SAMPLING and not acceptsArgument(
+            processFn, "sampling"
+        ):
+            warnings.warn(
+                f"Tofina: process of asset {self.name} does not support "
+                f"{sampling} sampling, falling back to pseudo-random sampling"
+            )
+            self.sampling = PSEUDO_RANDOM_SAMPLING
+
+    @property
+    def monteCarloSimulation(self) -> torch.Tensor:
+        """
+        Simulated on first access and re-simulated only once params were
+        replaced or modified in place.
+        """
+        if self.cachedSimulation is None or self.outdated():
+            self.monteCarloSimulation = self.simulate()
+        return self.cachedSimulation
+
+    @monteCarloSimulation.setter
+    def monteCarloSimulation(self, simulation: torch.Tensor) -> None:
+        if len(simulation.shape) == 3:
+            assert type(self.name) is tuple
+        if len(simulation.shape) == 2:
+            assert type(self.name) is str
+        self.simulatedParams = utils.tensorVersions(self.params)
+        self.cachedSimulation = simulation
+
+    def generator(self, chunkIndex: int = 0) -> torch.Generator:
+        """
+        Every (seed, asset name, chunk index) owns an independent generator,
+        so simulations do not depend on the global random state or on the
+        order in which assets and chunks are simulated.
+        """
+        generator = torch.Generator()
+        generator.manual_seed(streamSeed(self.seed, self.name, chunkIndex))
+        return generator
+
+    def expectation(self) -> Optional[torch.Tensor]:
+        """
+        Known expected value of the process in every period, shaped like a
+        single trial of the simulation. None if the process has no closed form.
+        """
+        expectationFn = processExpectations.get(self.processFn)
+        if expectationFn is None:
+            return None
+        return expectationFn(self.processLength, self.params)
+
+    def outdated(self) -> bool:
+        """
+        Whether params were replaced or modified in place since last simulation
+        """
+        if self.simulatedParams is None:
+            return True
+        return not utils.versionsMatch(
+            self.simulatedParams, utils.tensorVersions(self.params)
+        )
+
+    def storeKey(self, monteCarloTrials: int, chunkIndex: int = 0) -> Optional[str]:
+        if self.simulationStore is None:
+            return None
+        # Simulations differentiated with respect to params are always rerun
+        if torch.is_grad_enabled() and any(
+            param.requires_grad for param in self.params.values()
+        ):
+            return None
+        return self.simulationStore.key(
+            self.name,
+            self.processFn,
+            self.params,
+            self.seed,
+            self.sampling,
+            self.processLength,
+            monteCarloTrials,
+            chunkIndex,
+        )
+
+    def simulate(self, monteCarloTrials=None, chunkIndex: int = 0) -> torch.Tensor:
+        """
+        Loads the simulation from the simulation store when it holds one for
+        the same process, params, seed, sampling and shape.
+        """
         if monteCarloTrials is None:
             monteCarloTrials = self.monteCarloTrials
-        self.setSeed(123)
-        return self.processFn(self.processLength, monteCarloTrials, self.params)
+        key = self.storeKey(monteCarloTrials, chunkIndex)
+        if key is not None:
+            simulation = self.simulationStore.load(key)
+            if simulation is not None:
+                return simulation
+        simulation = self.runProcess(monteCarloTrials, chunkIndex)
+        if key is not None:
+            self.simulationStore.save(key, simulation)
+        return simulation
+
+    def runProcess(self, monteCarloTrials: int, chunkIndex: int = 0) -> torch.Tensor:
+        generator = self.generator(chunkIndex)
+        kwargs = {}
+        if self.sampling != PSEUDO_RANDOM_SAMPLING:
+            kwargs["sampling"] = self.sampling
+        if acceptsArgument(self.processFn, "generator"):
+            return self.processFn(
+                self.processLength,
+                monteCarloTrials,
+                self.params,
+                generator=generator,
+                **kwargs,
+            )
+        # Process functions without generator support draw from the global
+        # torch state, which is seeded from the stream and restored afterwards
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(generator.initial_seed())
+            return self.processFn(
+                self.processLength, monteCarloTrials, self.params, **kwargs
+            )
 
 
 def CompanyValueNormalDistributionProcess(
-    processLength: int, monteCarloTrials: int, params: dict
+    processLength: int,
+    monteCarloTrials: int,
+    params: dict,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
 ) -> torch.Tensor:
     mean = params["mean"]
     std = params["std"]
     initalValue = params["initialValue"]
     # reparametrization trick to make differentiable
-    sample = torch.randn((monteCarloTrials, processLength)) * std + mean
+    shocks = normalShocks(monteCarloTrials, processLength, generator, sampling)
+    sample = shocks * std + mean
     X = 1 + sample
     X[:, 0] = 1
     return initalValue * X.cumprod(axis=1)
 
 
 def CompanyValueMultiNormalDistributionProcess(
-    processLength: int, monteCarloTrials: int, params: dict
+    processLength: int,
+    monteCarloTrials: int,
+    params: dict,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
 ) -> torch.Tensor:
     mean = params["mean"]
     std = params["covarianceMatrix"]
     initialValue = params["initialValue"]
-    X = 1 + MultivariateNormal(mean, std).sample(
-        (monteCarloTrials, processLength)
-    ).permute(2, 0, 1)
+    # MultivariateNormal.sample does not accept a generator,
+    # so the Cholesky factor is applied to standard normal draws directly
+    choleskyFactor = torch.linalg.cholesky(std.float())
+    standardNormal = normalShocks(
+        monteCarloTrials, processLength, generator, sampling, dims=len(mean)
+    )
+    sample = mean + standardNormal @ choleskyFactor.T
+    X = 1 + sample.detach().permute(2, 0, 1)
     X[:, :, 0] = 1
     for i in range(len(initialValue)):
         X[i] = initialValue[i] * X[i].cumprod(axis=1)
@@ -77,23 +331,66 @@ def CompanyValueMultiNormalDistributionProcess(
 
 
 def CompanyValueBinomialProcess(
-    processLength: int, monteCarloTrials: int, params: dict
+    processLength: int,
+    monteCarloTrials: int,
+    params: dict,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
 ) -> torch.Tensor:
     S0 = params["S0"]
     u = params["u"]
     d = params["d"]
     qU = params["qU"]
+    shocks = uniformShocks(monteCarloTrials, processLength, generator, sampling)
     X = torch.zeros(monteCarloTrials, processLength)
     X[:, 0] = S0
     for i in range(1, processLength):
-        X[:, i] = X[:, i - 1] * torch.where(torch.rand(monteCarloTrials) < qU, u, d)
+        X[:, i] = X[:, i - 1] * torch.where(shocks[:, i] < qU, u, d)
     return X
 
 
 def GovernmentObligtaionProcess(
-    processLength: int, monteCarloTrials: int, params: dict
+    processLength: int,
+    monteCarloTrials: int,
+    params: dict,
+    generator: Optional[torch.Generator] = None,
+    sampling: str = PSEUDO_RANDOM_SAMPLING,
 ):
+    # Deterministic, every sampling mode gives the same trials
     initialValue = params["initialValue"]
     interestRate = params["interestRate"]
     X: torch.Tensor = initialValue * (1 + interestRate) ** torch.arange(processLength)
     return X.repeat(monteCarloTrials).reshape(monteCarloTrials, -1)
+
+
+def CompanyValueNormalDistributionExpectation(
+    processLength: int, params: dict
+) -> torch.Tensor:
+    growth = (1 + params["mean"]) ** torch.arange(processLength)
+    return params["initialValue"] * growth
+
+
+def CompanyValueMultiNormalDistributionExpectation(
+    processLength: int, params: dict
+) -> torch.Tensor:
+    growth = (1 + params["mean"].unsqueeze(1)) ** torch.arange(processLength)
+    return params["initialValue"].unsqueeze(1) * growth
+
+
+def CompanyValueBinomialExpectation(processLength: int, params: dict) -> torch.Tensor:
+    stepGrowth = params["qU"] * params["u"] + (1 - params["qU"]) * params["d"]
+    return params["S0"] * stepGrowth ** torch.arange(processLength)
+
+
+def GovernmentObligtaionExpectation(processLength: int, params: dict) -> torch.Tensor:
+    return params["initialValue"] * (1 + params["interestRate"]) ** torch.arange(
+        processLength
+    )
+
+
+processExpectations: Mapping[processFnType, expectationFnType] = {
+    CompanyValueNormalDistributionProcess: CompanyValueNormalDistributionExpectation,
+    CompanyValueMultiNormalDistributionProcess: CompanyValueMultiNormalDistributionExpectation,
+    CompanyValueBinomialProcess: CompanyValueBinomialExpectation,
+    GovernmentObligtaionProcess: GovernmentObligtaionExpectation,
+}
@@ -1,28 +1,40 @@
+import os
 import torch
+import functools
+import numpy as np
 import pandas as pd
-from typing import List, Union, Dict, Callable, Optional
+import multiprocessing
+from typing import List, Union, Dict, Callable, Optional, Tuple
 import datetime as dt
 import tofina.components.portfolio as portfolio
+import tofina.utils as utils
 from pathlib import Path
-from tofina.components import asset
+from tofina.components import asset, cache, store, logger, preference, strategy
 from tofina.components.instrument import (
     NonDerivativePayout,
     payoffFnType,
-    AmericanCallPayout,
-    AmericanPutPayout,
 )
 from tofina.components.strategy import BuyAndHold
-from tofina.macros.portfolioOptimization import optimizeStockPortfolioRiskAverse
-from tofina.components.optimizer import Optimizer
+from tofina.macros.portfolioOptimization import (
+    optimizeStockPortfolioRiskAverse,
+    riskAversePreference,
+)
+from tofina.components.optimizer import (
+    Optimizer,
+    BatchedEarlyStopping,
+    PortfolioOptimizationLoss,
+)
 from tqdm import tqdm
 
-
 forcastType = Callable[[str, str, int, int, dict], torch.Tensor]
 timeType = Union[
     str,
     pd.Timestamp,
     dt.datetime,
 ]
+# Per worker state of the forked pool in Backtester.optimizeInParallel, set
+# by initializeForkedWorker in each worker process only
+forkedWorker: dict = {}
 
 
 def numberOfTradingDaysBetweenTwoDays(start: timeType, end: timeType) -> int:
@@ -34,66 +46,187 @@ def numberOfTradingDaysBetweenTwoDays(start: timeType, end: timeType) -> int:
     return len(pd.bdate_range(start=start, end=end))
 
 
+@functools.lru_cache(maxsize=None)
+def businessDayCalendar(holidays: Tuple[str, ...] = ()) -> np.busdaycalendar:
+    return np.busdaycalendar(holidays=list(holidays))
+
+
+def tradingDaysBetween(
+    start: pd.Series, end: pd.Series, holidays: Tuple[str, ...] = ()
+) -> np.ndarray:
+    """
+    Vectorized numberOfTradingDaysBetweenTwoDays over whole columns, both
+    days inclusive, skipping holidays.
+    """
+    start = pd.to_datetime(start).values.astype("datetime64[D]")
+    end = pd.to_datetime(end).values.astype("datetime64[D]") + np.timedelta64(1, "D")
+    days = np.busday_count(start, end, busdaycal=businessDayCalendar(holidays))
+    return np.maximum(days, 0)
+
+
+class PricePanel:
+    """
+    Historical prices of all tickers as one contiguous (tickers x days)
+    tensor. Each row holds a ticker's prices on its own trading calendar,
+    left aligned and NaN padded at the end, so windows span a ticker's own
+    trading days. Horizon windows are strided views of it, and dates are
+    mapped to columns in one vectorized lookup.
+    """
+
+    def __init__(self, horizon: int):
+        self.horizon = horizon
+        self.tickers: Dict[str, int] = {}
+        self.dates: Dict[str, pd.Index] = {}
+        self.buffer = torch.empty((0, 0), dtype=torch.float64)
+
+    @property
+    def prices(self) -> torch.Tensor:
+        return self.buffer[: len(self.tickers)]
+
+    def addTicker(self, ticker: str, prices: pd.Series) -> None:
+        """
+        New tickers are written into spare rows, which are allocated
+        geometrically. Rows already handed out as views are never written,
+        so replacing a ticker or a longer calendar copy the panel instead.
+        """
+        row = self.tickers.get(ticker, len(self.tickers))
+        rows, width = self.buffer.shape
+        if ticker in self.tickers or row >= rows or len(prices) > width:
+            if row >= rows:
+                rows = max(2 * rows, 1)
+            buffer = torch.full((rows, max(width, len(prices))), np.nan)
+            buffer[: len(self.tickers), :width] = self.prices
+            self.buffer = buffer
+        self.buffer[row] = np.nan
+        self.buffer[row, : len(prices)] = torch.from_numpy(prices.to_numpy(np.float64))
+        self.tickers[ticker] = row
+        self.dates[ticker] = prices.index
+
+    def dateIndex(self, ticker: str, dates: List[timeType]) -> np.ndarray:
+        indices = self.dates[ticker].get_indexer(pd.to_datetime(list(dates)))
+        if (indices < 0).any():
+            missing = [date for date, index in zip(dates, indices) if index < 0]
+            raise KeyError(f"Tofina: no historical prices of {ticker} at {missing}")
+        return indices
+
+    def windows(self) -> torch.Tensor:
+        """
+        (tickers x window starts x horizon) view of every full horizon
+        window, sharing memory with prices. Window i of a ticker starts on
+        its i-th own trading day, so on misaligned calendars the same i can
+        be different dates for different tickers (see dateIndex). Windows
+        running past the end of a shorter ticker's data contain its NaN
+        padding.
+        """
+        return self.prices.unfold(1, self.horizon, 1)
+
+    def window(self, ticker: str, index: int) -> torch.Tensor:
+        # Windows near the end of the data are truncated, not dropped
+        end = min(index + self.horizon, len(self.dates[ticker]))
+        return self.prices[self.tickers[ticker], index:end]
+
+
 class Backtester:
-    def __init__(self, timestamps: List[timeType], horizon=20, monteCarloTrials=1000):
-        self.historicalTrajectory = {}
+    def __init__(
+        self,
+        timestamps: List[timeType],
+        horizon=20,
+        monteCarloTrials=1000,
+        cacheBudgetBytes: Optional[int] = None,
+        simulationStorePath: Optional[str] = None,
+        holidays: Optional[List[timeType]] = None,
+    ):
+        # One budget shared by the caches of every point in time portfolio
+        self.cacheBudget = cache.CacheBudget(cacheBudgetBytes)
+        self.simulationStore = None
+        if simulationStorePath is not None:
+            self.simulationStore = store.SimulationStore(simulationStorePath)
+        self.holidays = tuple(
+            str(pd.Timestamp(holiday).date()) for holiday in holidays or []
+        )
         self.timestamps = timestamps
         self.horizon = horizon
+        self.historicalPrices = PricePanel(horizon)
+        self.timestampIndex: Dict[str, Dict[timeType, int]] = {}
+        self.trajectories: Optional[Dict[timeType, Dict[str, torch.Tensor]]] = None
         self.pointInTimePortfolio: Dict[timeType, portfolio.Portfolio] = {}
         self.optimizers: Dict[timeType, Optimizer] = {}
+        self.optimizationResults: Dict[timeType, dict] = {}
         for timestamp in timestamps:
             self.pointInTimePortfolio[timestamp] = portfolio.Portfolio(
                 processLength=horizon,
                 monteCarloTrials=monteCarloTrials,
                 cache_asset=True,
                 cache_instrument=True,
+                cache_budget=self.cacheBudget,
+                simulationStore=self.simulationStore,
             )
-            self.historicalTrajectory[timestamp] = {}
 
     def stockDataFromDataFrame(self, df: pd.DataFrame, ticker: str):
-        self.historicalTrajectory[ticker] = {}
-        for timestamp in self.timestamps:
-            index = df.index.get_loc(timestamp)
-            ts = df["Close"].values[index : index + self.horizon]
-            self.historicalTrajectory[timestamp][ticker] = torch.from_numpy(
-                ts
+        self.historicalPrices.addTicker(ticker, df["Close"])
+        self.trajectories = None
+        indices = self.historicalPrices.dateIndex(ticker, self.timestamps)
+        self.timestampIndex[ticker] = dict(zip(self.timestamps, indices.tolist()))
+
+    def trajectory(self, timestamp: timeType) -> Dict[str, torch.Tensor]:
+        """
+        (1 x horizon) realized prices of every ticker from timestamp on,
+        views of historicalPrices.
+        """
+        return {
+            ticker: self.historicalPrices.window(
+                ticker, self.timestampIndex[ticker][timestamp]
             ).unsqueeze(0)
+            for ticker in self.historicalPrices.tickers
+        }
+
+    @property
+    def historicalTrajectory(self) -> Dict[timeType, Dict[str, torch.Tensor]]:
+        # Built once per set of tickers, adding stock data invalidates it
+        if self.trajectories is None:
+            self.trajectories = {
+                timestamp: self.trajectory(timestamp) for timestamp in self.timestamps
+            }
+        return self.trajectories
 
     def parseOptionData(
         self, df: pd.DataFrame, ticker: str, sampleOption: Optional[int] = None
     ):
-        for timestamp in self.pointInTimePortfolio.keys():
-            df_ = df[df["Date"] == timestamp]
+        """
+        Adds one option chain (a call and a put per row) to every timestamp
+        with options maturing within the horizon. Maturities of all rows are
+        computed at once and rows are split by Date in a single groupby.
+        sampleOption rows are sampled per timestamp before filtering.
+        """
+        timestamps = {
+            pd.Timestamp(timestamp): timestamp for timestamp in self.timestamps
+        }
+        dates = pd.to_datetime(df["Date"])
+        df = df[dates.isin(list(timestamps))].assign(
+            Date=dates,
+            Maturity=lambda df_: tradingDaysBetween(
+                df_["Date"], df_["Expiry Date"], self.holidays
+            ),
+        )
+        groups = dict(list(df.groupby("Date", sort=False)))
+        for date, timestamp in timestamps.items():
+            df_ = groups.get(date, df.iloc[:0])
             if sampleOption is not None:
                 df_ = df_.sample(sampleOption)
-
-            for i, row in tqdm(df_.iterrows()):
-                timestamp = row["Date"]
-                maturity = numberOfTradingDaysBetweenTwoDays(
-                    timestamp, row["Expiry Date"]
-                )
-                call_price = row["Call Ask"]
-                put_price = row["Put Ask"]
-                strike = row["Strike Price"]
-                params = {"maturity": maturity, "strikePrice": strike}
-                if maturity > self.horizon:
-                    continue
-
-                portfolio_ = self.pointInTimePortfolio[timestamp]
-                portfolio_.addInstrument(
-                    ticker,
-                    ticker + "_Call_" + str(strike) + "_" + str(maturity),
-                    AmericanCallPayout,
-                    call_price,
-                    **params,
-                )
-                portfolio_.addInstrument(
-                    ticker,
-                    ticker + "_Put_" + str(strike) + "_" + str(maturity),
-                    AmericanPutPayout,
-                    put_price,
-                    **params,
-                )
+            df_ = df_[df_["Maturity"] <= self.horizon]
+            if len(df_) == 0:
+                continue
+            # Calls and puts of a row are interleaved, one chain per
+            # timestamp computes payoffs of every strike at once
+            self.pointInTimePortfolio[timestamp].addOptionChain(
+                ticker,
+                ticker,
+                np.repeat(df_["Strike Price"].values, 2).tolist(),
+                np.repeat(df_["Maturity"].values, 2).tolist(),
+                np.tile([True, False], len(df_)).tolist(),
+                df_[["Call Ask", "Put Ask"]].values.ravel().tolist(),
+                optionType="American",
+            )
 
     def addDeposit(self, interestRate: float):
         for timestamp in self.timestamps:
@@ -119,7 +252,7 @@ class Backtester:
     ):
         for timestamp in self.timestamps:
             portfolio_ = self.pointInTimePortfolio[timestamp]
-            price = self.historicalTrajectory[timestamp][ticker][0][0]
+            price = self.trajectory(timestamp)[ticker][0][0]
             portfolio_.addInstrument(ticker, ticker + "_" + assetName, payoffFn, price)
 
     def registerForecaster(
@@ -130,18 +263,147 @@ class Backtester:
         for timestamp in self.timestamps:
             portfolio_ = self.pointInTimePortfolio[timestamp]
             for ticker in supported_tickers:
-
-                def processFn(processLength, monteCarloTrials, params):
+                # Simulation is lazy, so the loop variables are bound now
+                def processFn(
+                    processLength,
+                    monteCarloTrials,
+                    params,
+                    timestamp=timestamp,
+                    ticker=ticker,
+                ):
                     return forecast(
                         timestamp, ticker, processLength, monteCarloTrials, **params
                     )
 
                 portfolio_.addAsset(ticker, processFn)
 
-    def optimizeStrategy(self, logFolderPath: str, RiskAversion: float = 0.5, **kwargs):
+    def optimizeStrategy(
+        self,
+        logFolderPath: str,
+        RiskAversion: Union[float, List[float]] = 0.5,
+        workers: int = 1,
+        threadsPerWorker: Optional[int] = None,
+        utility: Optional[preference.Preference] = None,
+        **kwargs,
+    ):
+        """
+        A list of RiskAversion levels optimizes one portfolio per level in a
+        single run, with (levels x instruments) portfolioWeights.
+        utility replaces the default CRRA preference without time discount,
+        kwargs are passed to Optimizer.optimize.
+        workers > 1 optimizes timestamps in parallel, see optimizeInParallel.
+        """
         logFolderPath = Path(logFolderPath)
+        if utility is None:
+            utility = riskAversePreference(RiskAversion)
+        levels = utility.levels
+        # Initial weights are drawn in timestamp order whatever the number of
+        # workers, so parallel runs reproduce serial ones
+        for timestamp in self.timestamps:
+            portfolio_ = self.pointInTimePortfolio[timestamp]
+            portfolio_.setStrategy(
+                torch.rand(*levels, portfolio_.num_instruments),
+                BuyAndHold,
+                cache_returns=True,
+                cache_liquidations=True,
+            )
+        if workers > 1:
+            self.optimizeInParallel(
+                logFolderPath, utility, workers, threadsPerWorker, **kwargs
+            )
+            return
         for timestamp in tqdm(self.timestamps):
-            print("Tofina: Optimizing Portfolio at timestamp: ", timestamp)
+            optimizer_ = self.optimizeTimestamp(
+                timestamp, logFolderPath, utility, **kwargs
+            )
+            self.optimizers[timestamp] = optimizer_
+            self.optimizationResults[timestamp] = optimizer_.optimizationResult
+
+    def optimizeTimestamp(
+        self,
+        timestamp: timeType,
+        logFolderPath: Path,
+        utility: preference.Preference,
+        **kwargs,
+    ) -> Optimizer:
+        print("Tofina: Optimizing Portfolio at timestamp: ", timestamp)
+        return optimizeStockPortfolioRiskAverse(
+            self.pointInTimePortfolio[timestamp],
+            logFolderPath / f"portfolioOptimization_{timestamp}.csv",
+            utility=utility,
+            **kwargs,
+        )
+
+    def optimizeInParallel(
+        self,
+        logFolderPath: Path,
+        utility: preference.Preference,
+        workers: int,
+        threadsPerWorker: Optional[int] = None,
+        **kwargs,
+    ):
+        """
+        Shards timestamps across a pool of forked processes, each limited to
+        threadsPerWorker torch threads (default: cores / workers). Every
+        timestamp writes its own CSV log. The backtester reaches the workers
+        through the pool initializer, inherited on fork, so portfolios (and
+        their forecaster closures) are never pickled. Workers send back their
+        optimizers without portfolio, logger and metrics (see
+        Optimizer.__getstate__), which are reattached to the point in time
+        portfolios with the optimized weights, as in the serial path.
+        Requires the fork start method (Linux, macOS).
+        """
+        if threadsPerWorker is None:
+            threadsPerWorker = max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context("fork")
+        with context.Pool(
+            workers,
+            initializer=initializeForkedWorker,
+            initargs=(self, threadsPerWorker, logFolderPath, utility, kwargs),
+        ) as pool:
+            results = list(
+                tqdm(
+                    pool.imap(optimizeForkedTimestamp, self.timestamps),
+                    total=len(self.timestamps),
+                )
+            )
+        for timestamp, (optimizer_, weights) in zip(self.timestamps, results):
+            portfolio_ = self.pointInTimePortfolio[timestamp]
+            portfolio_.setPortfolioWeights(weights)
+            optimizer_.portfolio = portfolio_
+            self.optimizers[timestamp] = optimizer_
+            self.optimizationResults[timestamp] = optimizer_.optimizationResult
+
+    def optimizeStrategyBatched(
+        self,
+        logFolderPath: Optional[str] = None,
+        RiskAversion: float = 0.5,
+        iterations: int = 1000,
+        lr: float = 0.01,
+        earlyStoppingTolerance: float = 1e-8,
+        stop: bool = True,
+        optimizer: torch.optim.Optimizer = torch.optim.Adam,
+        utility: Optional[preference.Preference] = None,
+    ):
+        """
+        Same problem and arguments as optimizeStrategy, but timestamps with
+        the same number of instruments are optimized together in one autograd
+        graph with a leading timestamp dimension. PnL is linear in the
+        weights, so every timestamp is first reduced to a (trials x
+        instruments) matrix (see Optimizer.canReduceProblem). Timestamps stop
+        early independently and are frozen once they do. Preferences with
+        several levels are not supported.
+        """
+        preference_ = utility
+        if preference_ is None:
+            preference_ = riskAversePreference(RiskAversion)
+        if len(preference_.levels) > 0:
+            raise ValueError(
+                "Tofina: batched optimization takes a single preference level, "
+                "use optimizeStrategy for frontiers"
+            )
+        batches: Dict[int, List[timeType]] = {}
+        for timestamp in self.timestamps:
             portfolio_ = self.pointInTimePortfolio[timestamp]
             portfolio_.setStrategy(
                 torch.rand(portfolio_.num_instruments),
@@ -149,12 +411,102 @@ class Backtester:
                 cache_returns=True,
                 cache_liquidations=True,
             )
-            self.optimizers[timestamp] = optimizeStockPortfolioRiskAverse(
-                portfolio_,
-                logFolderPath / f"portfolioOptimization_{timestamp}.csv",
-                RiskAversion,
-                **kwargs,
+            batches.setdefault(portfolio_.num_instruments, []).append(timestamp)
+        for timestamps in batches.values():
+            self.optimizeBatch(
+                timestamps,
+                preference_,
+                logFolderPath,
+                iterations,
+                lr,
+                earlyStoppingTolerance,
+                stop,
+                optimizer,
+            )
+
+    def optimizeBatch(
+        self,
+        timestamps: List[timeType],
+        preference_: preference.Preference,
+        logFolderPath: Optional[str],
+        iterations: int,
+        lr: float,
+        earlyStoppingTolerance: float,
+        stop: bool,
+        optimizer: torch.optim.Optimizer = torch.optim.Adam,
+    ):
+        portfolios = [self.pointInTimePortfolio[timestamp] for timestamp in timestamps]
+        with torch.no_grad():
+            timeDiscounts = preference_.timeDiscounts(self.horizon - 1).float()
+            discountedProfits = torch.stack(
+                [
+                    portfolio_.simulateReducedPnL(timeDiscounts)
+                    for portfolio_ in portfolios
+                ]
+            )
+        weights = torch.stack(
+            [portfolio_.strategy.portfolioWeights.detach() for portfolio_ in portfolios]
+        ).requires_grad_()
+        loggers = []
+        if logFolderPath is not None:
+            loggers = [
+                logger.CsvLogger(
+                    Path(logFolderPath) / f"portfolioOptimization_{timestamp}.csv"
+                )
+                for timestamp in timestamps
+            ]
+
+        def batchLoss(t: int) -> torch.Tensor:
+            normalizedWeights = strategy.normalizeWeights(weights)
+            aggregatedMoney = torch.einsum(
+                "bni,bi->nb",
+                discountedProfits,
+                normalizedWeights.to(discountedProfits.dtype),
+            )
+            loss = PortfolioOptimizationLoss(
+                preference_.aggregatedUtility(aggregatedMoney), preference_.params
             )
+            for index, logger_ in enumerate(loggers):
+                record = {
+                    name + "weight": utils.tensorToFloat(weight)
+                    for name, weight in zip(
+                        portfolios[index].instruments, normalizedWeights[index]
+                    )
+                }
+                record["loss"] = utils.tensorToFloat(loss[index])
+                logger_.processRecord(record, t)
+            return loss
+
+        optim = optimizer([weights], lr=lr)
+        earlyStop = BatchedEarlyStopping(len(timestamps), tol=earlyStoppingTolerance)
+        converged = torch.zeros(len(timestamps), dtype=torch.bool)
+        with torch.no_grad():
+            initialLoss = batchLoss(-1)
+        for i in tqdm(range(iterations)):
+            optim.zero_grad()
+            loss = batchLoss(i)
+            loss.sum().backward()
+            # Frozen rows get no gradient, so their optimizer state stays as
+            # it was when they stopped, and their values are restored after
+            # steps that still move them through momentum
+            weights.grad[converged] = 0
+            frozen = weights.detach().clone()
+            optim.step()
+            with torch.no_grad():
+                weights[converged] = frozen[converged]
+            if stop:
+                converged |= earlyStop(loss.detach())
+                if converged.all():
+                    break
+        with torch.no_grad():
+            finalLoss = batchLoss(i + 1)
+        for index, timestamp in enumerate(timestamps):
+            portfolios[index].setPortfolioWeights(weights[index].detach().clone())
+            self.optimizationResults[timestamp] = {
+                "initial_loss": utils.tensorToFloat(initialLoss[index]),
+                "final_loss": utils.tensorToFloat(finalLoss[index]),
+                "converged": bool(converged[index]),
+            }
 
     def evaluateStrategy(self):
         comparison = {}
@@ -163,8 +515,6 @@ class Backtester:
 
             portfolio_ = self.pointInTimePortfolio[timestamp]
             comparison[timestamp]["simulation"] = portfolio_.simulatePnL()
-            portfolio_.caclculationsCache.invalidate_all_cache()
-            portfolio_.strategy.calculationsCache.invalidate_all_cache()
             portfolio_.regenerateAssetsAndInstrumentsWithRealData(
                 self.historicalTrajectory[timestamp]
             )
@@ -173,3 +523,30 @@ class Backtester:
 
     def aggregateResults(self):
         pass
+
+
+def initializeForkedWorker(
+    backtester: Backtester,
+    threadsPerWorker: int,
+    logFolderPath: Path,
+    utility: preference.Preference,
+    kwargs: dict,
+) -> None:
+    torch.set_num_threads(threadsPerWorker)
+    forkedWorker.update(
+        backtester=backtester,
+        logFolderPath=logFolderPath,
+        utility=utility,
+        kwargs=kwargs,
+    )
+
+
+def optimizeForkedTimestamp(timestamp: timeType) -> Tuple[Optimizer, torch.Tensor]:
+    optimizer_ = forkedWorker["backtester"].optimizeTimestamp(
+        timestamp,
+        forkedWorker["logFolderPath"],
+        forkedWorker["utility"],
+        **forkedWorker["kwargs"],
+    )
+    weights = optimizer_.portfolio.strategy.portfolioWeights.detach()
+    return optimizer_, weights
@@ -1,16 +1,105 @@
+import time
+import pandas as pd
+import tofina.utils as utils
+from collections import OrderedDict
+from typing import Optional
 from tofina.constants import ASSET_CACHE_KEY, INSTRUMENT_CACHE_KEY
 
 
+def tensor_bytes(value) -> int:
+    return sum(
+        tensor.nelement() * tensor.element_size()
+        for tensor in utils.flattenTensors(value)
+    )
+
+
+class CacheBudget:
+    """
+    Memory budget in tensor bytes, shared by any number of CalculationCache
+    instances. Entries of all caches form one LRU order, so when the budget
+    is exceeded the least recently used entry is evicted, whichever cache
+    it belongs to. max_bytes=None means unbounded.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+
+    # Entries are keyed by cache id rather than the cache itself, keeping
+    # the keys printable for iterateOptimizerParams
+    def touch(self, cache, key):
+        self.entries.move_to_end((id(cache), key))
+
+    def add(self, cache, key, nbytes):
+        self.entries[(id(cache), key)] = (cache, nbytes)
+        self.total_bytes += nbytes
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            lru_entry, (lru_cache, _) = next(iter(self.entries.items()))
+            if lru_entry == (id(cache), key):
+                break
+            lru_cache.evict(lru_entry[1])
+            self.evictions += 1
+
+    def remove(self, cache, key):
+        _, nbytes = self.entries.pop((id(cache), key), (cache, 0))
+        self.total_bytes -= nbytes
+
+    def stats_report(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "total_bytes": self.total_bytes,
+            "entries": len(self.entries),
+            "evictions": self.evictions,
+        }
+
+
 class CalculationCache:
-    def __init__(self):
+    def __init__(self, budget: Optional[CacheBudget] = None):
         self.storage = {}
+        self.versions = {}
         self.allowed_keys = set()
+        self.budget = budget if budget is not None else CacheBudget()
+        self.stats = {}
 
     def register_key(self, key):
         self.allowed_keys.add(key)
 
-    def update(self, key, value):
+    def key_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = {
+                "hits": 0,
+                "misses": 0,
+                "stale": 0,
+                "evictions": 0,
+                "compute_time": 0.0,
+                "bytes": 0,
+            }
+        return self.stats[key]
+
+    def update(self, key, value, versions=None):
+        """
+        versions is a utils.tensorVersions snapshot of the inputs value was
+        computed from, None for values that never go stale.
+        """
+        if key in self.storage:
+            self.budget.remove(self, key)
         self.storage[key] = value
+        self.versions[key] = versions
+        nbytes = tensor_bytes(value)
+        self.key_stats(key)["bytes"] = nbytes
+        self.budget.add(self, key, nbytes)
+
+    def evict(self, key):
+        if key not in self.storage:
+            return
+        del self.storage[key]
+        del self.versions[key]
+        self.budget.remove(self, key)
+        stats = self.key_stats(key)
+        stats["evictions"] += 1
+        stats["bytes"] = 0
 
     def use_stale_assets_and_instruments(self):
         cache_assets = ASSET_CACHE_KEY in self.allowed_keys
@@ -18,14 +107,53 @@ class CalculationCache:
         return cache_assets and cache_instruments
 
     def invalidate_all_cache(self):
+        for key in self.storage:
+            self.budget.remove(self, key)
+            self.key_stats(key)["bytes"] = 0
         self.storage = {}
+        self.versions = {}
+
+    def stats_report(self) -> pd.DataFrame:
+        """
+        Per-key hits, misses, misses caused by changed inputs (stale),
+        evictions, time spent recomputing on misses (seconds) and bytes
+        currently held.
+        """
+        return pd.DataFrame.from_dict(self.stats, orient="index")
+
+    def is_fresh(self, key, versions):
+        if key not in self.storage:
+            return False
+        if self.versions[key] is None:
+            return True
+        return utils.versionsMatch(self.versions[key], versions)
+
+    def __call__(self, f, key, dependencies=None):
+        """
+        Entries are valid for the exact tensors (and their in-place versions)
+        passed as arguments or returned by dependencies(), so they are
+        recomputed only once one of those inputs is replaced or modified.
+        """
 
-    def __call__(self, f, key):
         def wrapper(*args, **kwargs):
             if key not in self.allowed_keys:
                 return f(*args, **kwargs)
-            if key not in self.storage:
-                self.storage[key] = f(*args, **kwargs)
-            return self.storage[key]
+            stats = self.key_stats(key)
+            inputs = [args, kwargs]
+            if dependencies is not None:
+                inputs.append(dependencies())
+            versions = utils.tensorVersions(inputs)
+            if self.is_fresh(key, versions):
+                stats["hits"] += 1
+                self.budget.touch(self, key)
+                return self.storage[key]
+            if key in self.storage:
+                stats["stale"] += 1
+            stats["misses"] += 1
+            start = time.perf_counter()
+            value = f(*args, **kwargs)
+            stats["compute_time"] += time.perf_counter() - start
+            self.update(key, value, versions)
+            return value
 
         return wrapper
@@ -1,9 +1,25 @@
 import torch
 import tofina.utils as utils
+from tofina.components import arena
 from tofina.components.asset import Asset
-from typing import Callable
+from typing import Callable, List, Optional
 
 payoffFnType = Callable[[torch.Tensor, int, dict], torch.Tensor]
+vectorizedPayoffFnType = Callable[[torch.Tensor, dict], torch.Tensor]
+
+
+def vectorizedPayoff(vectorizedFn: vectorizedPayoffFnType):
+    """
+    Attaches an implementation that evaluates all periods at once to a
+    per-period payoff function. vectorizedFn receives the (trials x horizon)
+    asset simulation and returns the (trials x horizon) payout.
+    """
+
+    def decorator(payoffFn: payoffFnType) -> payoffFnType:
+        payoffFn.vectorized = vectorizedFn
+        return payoffFn
+
+    return decorator
 
 
 class Instrument:
@@ -24,13 +40,33 @@ class Instrument:
             torch.tensor([price]).float(), requires_grad=False
         )
         self.params = utils.convertKwargsToTorchParameters(kwargs)
-        self.revenue = self.calculateProfit()
+        self.cachedRevenue = None
+        self.revenueVersions = None
+        self.arena: Optional[arena.Arena] = None
+        self.arenaIndex = None
+
+    def placeInArena(self, arena_: arena.Arena, index: int) -> None:
+        """
+        Revenue computed from now on is written straight into slot index of
+        the arena and kept as a view of it.
+        """
+        self.arena = arena_
+        self.arenaIndex = index
+        self.revenueVersions = None
+
+    @property
+    def revenue(self) -> torch.Tensor:
+        return lazyRevenue(self, [self.assetSimulation, self.params])
 
     def updateAssetSimulation(self, newAssetSimulation: torch.Tensor) -> None:
+        if utils.sameTensorView(newAssetSimulation, self.assetSimulation):
+            return
         self.assetSimulation = newAssetSimulation
-        self.revenue = self.calculateProfit()
 
     def calculateProfit(self) -> torch.Tensor:
+        vectorizedFn = getattr(self.payoff, "vectorized", None)
+        if vectorizedFn is not None:
+            return vectorizedFn(self.assetSimulation, self.params)
         instrumentPayout = []
         processLength = self.assetSimulation.shape[-1]
         for t in range(processLength):
@@ -46,13 +82,31 @@ def OneTimeComissionDecorator(comission: float, payoffFn: payoffFnType) -> payof
     def comissionPayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
         return payoffFn(X, t, params) - comission
 
+    vectorizedFn = getattr(payoffFn, "vectorized", None)
+    if vectorizedFn is not None:
+
+        def comissionPayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+            return vectorizedFn(X, params) - comission
+
+        comissionPayout.vectorized = comissionPayoutVectorized
     return comissionPayout
 
 
+def NonDerivativePayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    # Revenue must not alias the asset simulation
+    return X.clone()
+
+
+def NonDerivativePayoutShortVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    return X[:, :1] + (X[:, :1] - X)
+
+
+@vectorizedPayoff(NonDerivativePayoutVectorized)
 def NonDerivativePayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return X[t]
 
 
+@vectorizedPayoff(NonDerivativePayoutShortVectorized)
 def NonDerivativePayoutShort(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return X[0] + (X[0] - X[t])
 
@@ -82,17 +136,247 @@ def optionPayout_(
     return payout
 
 
+def optionPayoutVectorized_(
+    X: torch.Tensor,
+    params: dict,
+    isCall: bool = True,
+    optionType: str = "European",
+) -> torch.Tensor:
+    if optionType not in ["European", "American"]:
+        raise ValueError("optionType must be either European or American")
+
+    strikePrice = params["strikePrice"]
+    maturity = params["maturity"] - 1
+    periods = torch.arange(X.shape[-1])
+    if optionType == "European":
+        exercisable = periods == maturity
+    else:
+        exercisable = periods <= maturity
+
+    if isCall:
+        payout = X - strikePrice
+    else:
+        payout = strikePrice - X
+    payout = payout.clamp(min=0)
+    return torch.where(exercisable, payout, torch.zeros((), dtype=payout.dtype))
+
+
+def EuropeanCallPayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    return optionPayoutVectorized_(X, params, isCall=True, optionType="European")
+
+
+def EuropeanPutPayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    return optionPayoutVectorized_(X, params, isCall=False, optionType="European")
+
+
+def AmericanCallPayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    return optionPayoutVectorized_(X, params, isCall=True, optionType="American")
+
+
+def AmericanPutPayoutVectorized(X: torch.Tensor, params: dict) -> torch.Tensor:
+    return optionPayoutVectorized_(X, params, isCall=False, optionType="American")
+
+
+@vectorizedPayoff(EuropeanCallPayoutVectorized)
 def EuropeanCallPayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return optionPayout_(X, t, params, isCall=True, optionType="European")
 
 
+@vectorizedPayoff(EuropeanPutPayoutVectorized)
 def EuropeanPutPayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return optionPayout_(X, t, params, isCall=False, optionType="European")
 
 
+@vectorizedPayoff(AmericanCallPayoutVectorized)
 def AmericanCallPayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return optionPayout_(X, t, params, isCall=True, optionType="American")
 
 
+@vectorizedPayoff(AmericanPutPayoutVectorized)
 def AmericanPutPayout(X: torch.Tensor, t: int, params: dict) -> torch.Tensor:
     return optionPayout_(X, t, params, isCall=False, optionType="American")
+
+
+class ReadOnlyParams(dict):
+    """
+    Params that are derived from another object and must not be replaced.
+    Tensors can still be modified in place, which edits their source.
+    """
+
+    def readOnly(self, *args, **kwargs):
+        raise TypeError("Tofina: params are read-only views, edit them in place")
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = readOnly
+
+    def __reduce__(self):
+        return ReadOnlyParams, (dict(self),)
+
+
+class OptionChainContract(Instrument):
+    """
+    Single contract of an OptionChain. Revenue is a view into the batched
+    payoff tensor of the chain, and strikePrice and maturity params are
+    views of the chain tensors, so the contract plugs into Portfolio and
+    Strategy like any other instrument.
+    """
+
+    def __init__(
+        self,
+        chain: "OptionChain",
+        index: int,
+        name: str,
+        payoffFn: payoffFnType,
+        price: float,
+    ) -> None:
+        self.chain = chain
+        self.index = index
+        super().__init__(name, chain.assetName, chain.assetSimulation, payoffFn, price)
+        self.params = ReadOnlyParams(
+            strikePrice=chain.strikePrices[index],
+            maturity=chain.maturities[index],
+        )
+
+    @property
+    def assetSimulation(self) -> torch.Tensor:
+        return self.chain.assetSimulation
+
+    @assetSimulation.setter
+    def assetSimulation(self, newAssetSimulation: torch.Tensor) -> None:
+        self.chain.updateAssetSimulation(newAssetSimulation)
+
+    @property
+    def revenue(self) -> torch.Tensor:
+        return self.chain.revenue[self.index]
+
+    def placeInArena(self, arena_: arena.Arena, index: int) -> None:
+        # Revenue lives in the payoff tensor of the chain
+        return
+
+    def updateAssetSimulation(self, newAssetSimulation: torch.Tensor) -> None:
+        self.chain.updateAssetSimulation(newAssetSimulation)
+
+
+class OptionChain:
+    """
+    Options with many strikes and maturities on one underlying.
+    Payoffs of all contracts are computed in a single broadcast operation
+    into a (contracts x trials x horizon) tensor. Contract params are views
+    of strikePrices and maturities, which are therefore updated in place.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        assetName: str,
+        assetSimulation: torch.Tensor,
+        strikePrices: List[float],
+        maturities: List[int],
+        isCall: List[bool],
+        prices: List[float],
+        optionType: str = "American",
+        contractNames: Optional[List[str]] = None,
+    ) -> None:
+        if optionType not in ["European", "American"]:
+            raise ValueError("optionType must be either European or American")
+        self.name = name
+        self.assetName = assetName
+        self.assetSimulation = assetSimulation
+        self.optionType = optionType
+        self._strikePrices = torch.tensor(strikePrices).float()
+        self._maturities = torch.tensor(maturities).long()
+        self.isCall = torch.tensor(isCall).bool()
+        if contractNames is None:
+            contractNames = [
+                name
+                + ("_Call_" if call else "_Put_")
+                + str(strike)
+                + "_"
+                + str(maturity)
+                for strike, maturity, call in zip(strikePrices, maturities, isCall)
+            ]
+        self.contracts = [
+            OptionChainContract(
+                self,
+                index,
+                contractNames[index],
+                optionPayoutFunctions[(optionType, bool(isCall[index]))],
+                prices[index],
+            )
+            for index in range(len(contractNames))
+        ]
+        self.cachedRevenue = None
+        self.revenueVersions = None
+        self.arena = None
+
+    @property
+    def strikePrices(self) -> torch.Tensor:
+        return self._strikePrices
+
+    @strikePrices.setter
+    def strikePrices(self, strikePrices) -> None:
+        with torch.no_grad():
+            self._strikePrices.copy_(torch.as_tensor(strikePrices))
+
+    @property
+    def maturities(self) -> torch.Tensor:
+        return self._maturities
+
+    @maturities.setter
+    def maturities(self, maturities) -> None:
+        with torch.no_grad():
+            self._maturities.copy_(torch.as_tensor(maturities))
+
+    @property
+    def revenue(self) -> torch.Tensor:
+        return lazyRevenue(
+            self,
+            [self.assetSimulation, self.strikePrices, self.maturities, self.isCall],
+        )
+
+    def updateAssetSimulation(self, newAssetSimulation: torch.Tensor) -> None:
+        # Every contract forwards the update, the chain recomputes only once
+        if utils.sameTensorView(newAssetSimulation, self.assetSimulation):
+            return
+        self.assetSimulation = newAssetSimulation
+
+    def calculateProfit(self) -> torch.Tensor:
+        X = self.assetSimulation.unsqueeze(0)
+        strikePrices = self.strikePrices.view(-1, 1, 1)
+        payout = torch.where(
+            self.isCall.view(-1, 1, 1), X - strikePrices, strikePrices - X
+        ).clamp(min=0)
+
+        periods = torch.arange(X.shape[-1])
+        maturities = self.maturities.view(-1, 1) - 1
+        if self.optionType == "European":
+            exercisable = periods == maturities
+        else:
+            exercisable = periods <= maturities
+        return torch.where(
+            exercisable.unsqueeze(1), payout, torch.zeros((), dtype=payout.dtype)
+        )
+
+
+def lazyRevenue(owner, inputs: list) -> torch.Tensor:
+    """
+    Revenue is computed on first access and recomputed only once one of
+    its input tensors was replaced or modified in place.
+    """
+    versions = utils.tensorVersions(inputs)
+    if owner.revenueVersions is None or not utils.versionsMatch(
+        owner.revenueVersions, versions
+    ):
+        revenue = owner.calculateProfit()
+        if owner.arena is not None:
+            revenue = owner.arena.place(owner.arenaIndex, revenue)
+        owner.cachedRevenue = revenue
+        owner.revenueVersions = versions
+    return owner.cachedRevenue
+
+
+optionPayoutFunctions = {
+    ("European", True): EuropeanCallPayout,
+    ("European", False): EuropeanPutPayout,
+    ("American", True): AmericanCallPayout,
+    ("American", False): AmericanPutPayout,
+}
@@ -1,4 +1,18 @@
 import torch
+from typing import Callable
+
+metricFnType = Callable[..., torch.Tensor]
+
+
+def batchedMetric(metricFn: metricFnType, profits: torch.Tensor) -> torch.Tensor:
+    """
+    Applies a metric to every row of (candidates x trials) profits,
+    vectorized with vmap when the metric allows it.
+    """
+    try:
+        return torch.vmap(metricFn)(profits)
+    except (RuntimeError, ValueError):
+        return torch.stack([torch.as_tensor(metricFn(row)) for row in profits])
 
 
 def profitPercentile(p=0.05):
@@ -1,15 +1,24 @@
+import ast
 import torch
+import operator
+import warnings
 import tofina.utils as utils
 from tqdm import tqdm
 from tofina.components import (
     portfolio,
     preference,
+    strategy,
     logger,
+    metrics,
 )
-from typing import Optional, List, Callable
+from typing import Any, Optional, List, Callable, Mapping, Tuple
 
 MetricFnType = Callable[[List[torch.Tensor], dict], torch.Tensor]
 EmptyLogger = logger.Logger()
+WEIGHTS_TARGET = "portfolio.strategy.portfolioWeights"
+REVENUE_TARGET = "revenue"
+COMPILE_BACKEND = "inductor"
+compiledPipelines = {}
 
 
 class Optimizer:
@@ -18,15 +27,20 @@ class Optimizer:
         portfolio: portfolio.Portfolio,
         preference: preference.Preference,
         logger: Optional[logger.Logger] = None,
+        controlVariates: bool = False,
+        compiled: bool = False,
+        compileBackend: str = COMPILE_BACKEND,
         **kwargs
     ) -> None:
         self.portfolio = portfolio
         self.preference = preference
+        self.useControlVariates = controlVariates
+        self.compiled = compiled
+        self.compileBackend = compileBackend
+        self.reducedProblem = None
+        self.accessors = {}
+        self.targetRegistry = None
         self.calculateUtility()
-        (
-            self.availableLossTargets,
-            self.availableOptimizationTargets,
-        ) = iterateOptimizerParams(self)
         self.params = utils.convertKwargsToTorchParameters(kwargs)
         self.metrics = {}
 
@@ -36,17 +50,229 @@ class Optimizer:
         self.initialMetrics = {}
         self.finalMetrics = {}
 
+    def __getstate__(self) -> dict:
+        """
+        Pickles the optimization state (preference, params, loss, results and
+        last utility) without the portfolio, logger and registered metrics,
+        which hold closures tied to the process that built them.
+        """
+        state = self.__dict__.copy()
+        for key in ["portfolio", "logger", "metrics", "accessors", "targetRegistry"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.portfolio = None
+        self.logger = EmptyLogger
+        self.metrics = {}
+        self.accessors = {}
+        self.targetRegistry = None
+
+    @property
+    def availableLossTargets(self) -> List[str]:
+        return self.targets()[0]
+
+    @property
+    def availableOptimizationTargets(self) -> List[str]:
+        return self.targets()[1]
+
+    def targets(self) -> Tuple[List[str], List[str]]:
+        """
+        Loss and optimization targets reachable from the optimizer. Walking
+        the object graph evaluates every property (e.g. simulations), so it
+        is done on first request only.
+        """
+        if self.targetRegistry is None:
+            self.targetRegistry = iterateOptimizerParams(self)
+        return self.targetRegistry
+
+    def accessor(self, target: str) -> Callable[[Any], Any]:
+        if target not in self.accessors:
+            self.accessors[target] = compileTarget(target)
+        return self.accessors[target]
+
+    def resolveTarget(self, target: str) -> Any:
+        return self.accessor(target)(self)
+
+    def checkLevels(self) -> None:
+        """
+        Preferences with several levels score one portfolio per level, so
+        portfolioWeights need one row per level. Otherwise the utilities of
+        all levels would be summed into a single loss.
+        """
+        levels = self.preference.levels
+        if levels.numel() <= 1:
+            return
+        weightsShape = self.portfolio.strategy.portfolioWeights.shape
+        if weightsShape[:-1] != levels:
+            raise ValueError(
+                f"Tofina: preference levels {tuple(levels)} need portfolioWeights "
+                f"with one row per level, got shape {tuple(weightsShape)}"
+            )
+
     def calculateUtility(self) -> None:
+        self.checkLevels()
+        if self.reducedProblem is not None:
+            profits = self.reducedProblem["profits"]
+            weights = self.portfolio.strategy.normalizedWeights.to(profits.dtype)
+            self.profits = profits @ weights
+            self.utility = self.preference.aggregatedUtility(
+                self.reducedProblem["discountedProfits"] @ weights,
+                self.reducedProblem["controlVariates"],
+            )
+            return
+        if self.portfolio.streaming:
+            self.streamUtility()
+            return
+        if self.compiled and not self.optimizesFrontier():
+            self.compiledUtility()
+            return
         self.revenue = self.portfolio.simulatePnL()
-        self.profits = self.revenue.sum(axis=1)
-        self.utility = self.preference.utility(self.revenue)
+        self.profits = self.revenue.sum(axis=-1)
+        self.utility = self.revenueUtility(self.revenue)
+
+    def optimizesFrontier(self) -> bool:
+        """
+        portfolioWeights of shape (levels x instruments) hold one portfolio
+        per preference level (e.g. a vector of RiskAversion), every row
+        scored at its own level. Simulations and effective returns are
+        shared, and the summed loss has independent gradients per row, so
+        the whole frontier is optimized in one run. Each level stops early
+        on its own loss and is frozen once it does.
+        """
+        return self.portfolio.strategy.portfolioWeights.ndim > 1
+
+    def revenueUtility(self, revenue: torch.Tensor) -> torch.Tensor:
+        if self.optimizesFrontier():
+            return self.preference.frontierUtility(revenue, self.controlVariates())
+        return self.preference.utility(revenue, self.controlVariates())
+
+    def compiledUtility(self) -> None:
+        """
+        Runs PnL -> discounting -> money utility as one compiled graph.
+        Simulation and liquidation schedules stay eager (and cached), only
+        the tensor pipeline on top of them is compiled. The compiled function
+        is shared module-wide, so portfolios of the same structure and shape
+        (e.g. consecutive backtest timestamps) reuse the same graph.
+        Falls back to eager execution if compilation fails.
+        """
+        strategy_ = self.portfolio.strategy
+        assetX, instrumentX = self.portfolio.assetsAndInstruments()
+        inputs = (
+            strategy_.liquidations(assetX),
+            instrumentX,
+            strategy_.normalizedWeights,
+            strategy_.prices,
+            self.preference.timeDiscounts(self.portfolio.processLength - 1),
+            self.preference.moneyUtilityFn,
+            self.preference.params,
+        )
+        try:
+            revenue, utilities = compiledPnLUtility(self.compileBackend)(*inputs)
+        except Exception as error:
+            warnings.warn(
+                "Tofina: compiled pipeline failed, falling back to eager mode: "
+                + str(error)
+            )
+            self.compiled = False
+            revenue, utilities = pnlUtility(*inputs)
+        controlVariates = self.controlVariates()
+        if controlVariates is not None:
+            utilities = utils.controlVariateAdjustment(utilities, controlVariates)
+        self.revenue = revenue
+        self.profits = revenue.sum(axis=1)
+        self.utility = utilities.mean(axis=0)
+
+    def controlVariates(self) -> Optional[torch.Tensor]:
+        if not self.useControlVariates:
+            return None
+        return self.portfolio.controlVariates()
+
+    def streamUtility(self) -> None:
+        """
+        Accumulates utility, revenue and profits chunk by chunk without
+        keeping the autograd graph. Utility is exposed as a leaf, so its
+        gradient can be pushed through the chunks afterwards by
+        backwardStreamedUtility.
+        """
+        trials = self.portfolio.monteCarloTrials
+        utility = 0.0
+        revenues = []
+        with torch.no_grad():
+            for revenue in self.portfolio.simulatePnLChunks():
+                chunkWeight = revenue.shape[-2] / trials
+                utility = utility + self.revenueUtility(revenue) * chunkWeight
+                revenues.append(revenue)
+        self.revenue = torch.cat(revenues, dim=-2)
+        self.profits = self.revenue.sum(axis=-1)
+        self.utility = utility.requires_grad_(torch.is_grad_enabled())
+
+    def backwardStreamedUtility(self) -> None:
+        if self.utility.grad is None:
+            return
+        trials = self.portfolio.monteCarloTrials
+        for revenue in self.portfolio.simulatePnLChunks():
+            chunkWeight = revenue.shape[-2] / trials
+            chunkUtility = self.revenueUtility(revenue) * chunkWeight
+            if chunkUtility.requires_grad:
+                chunkUtility.backward(self.utility.grad)
+
+    def evaluateCandidates(
+        self,
+        candidateWeights: torch.Tensor,
+        metrics_: Optional[Mapping[str, metrics.metricFnType]] = None,
+    ) -> dict:
+        """
+        Revenue, profits, utility and metrics of every row of a
+        (candidates x instruments) weight matrix in one batched pass, e.g.
+        for random search, grid scans or efficient frontiers.
+        Metrics are functions of profits, as in components.metrics.
+        """
+        revenue = self.portfolio.simulateBatchedPnL(candidateWeights)
+        profits = revenue.sum(axis=-1)
+        result = {
+            "revenue": revenue,
+            "profits": profits,
+            "utility": self.preference.batchedUtility(revenue, self.controlVariates()),
+        }
+        for name, metricFn in (metrics_ or {}).items():
+            result[name] = metrics.batchedMetric(metricFn, profits)
+        return result
+
+    def canReduceProblem(self, paramsToOptimize: List[str]) -> bool:
+        """
+        Effective returns do not depend on portfolio weights, so when weights
+        are the only thing being optimized PnL is linear in them and can be
+        evaluated from a precomputed (trials x instruments) matrix.
+        Full per-period revenue is not available in that case.
+        Frontiers and multi-level preferences are not reduced.
+        """
+        if list(paramsToOptimize) != [WEIGHTS_TARGET] or self.portfolio.streaming:
+            return False
+        if self.optimizesFrontier() or self.preference.levels:
+            return False
+        targets = list(getattr(self, "lossTargets", []))
+        for metric in self.metrics.values():
+            targets += metric["targets"]
+        return not any(target.startswith(REVENUE_TARGET) for target in targets)
+
+    def reduceProblem(self) -> dict:
+        with torch.no_grad():
+            periods = self.portfolio.processLength - 1
+            timeDiscounts = self.preference.timeDiscounts(periods).float()
+            return {
+                "profits": self.portfolio.simulateReducedPnL(),
+                "discountedProfits": self.portfolio.simulateReducedPnL(timeDiscounts),
+                "controlVariates": self.controlVariates(),
+            }
 
     def initiateOptimizer(
         self, paramsToOptimize: List[str], optimizer: torch.optim.Optimizer, lr: float
     ) -> torch.optim.Optimizer:
         params = []
         for param in paramsToOptimize:
-            params.append(eval("self." + param))
+            params.append(self.resolveTarget(param))
         for param in params:
             param.requires_grad = True
         optim = optimizer(params, lr=lr)
@@ -57,6 +283,8 @@ class Optimizer:
     ) -> None:
         self.lossTargets = lossTargets
         self.lossFn = lossFn
+        for target in lossTargets:
+            self.accessor(target)
         for param in kwargs:
             self.params[param] = kwargs[param]
 
@@ -67,11 +295,13 @@ class Optimizer:
             "targets": metricTargets,
             "fn": metricFn,
         }
+        for target in metricTargets:
+            self.accessor(target)
 
     def applyLoss(self, lossTargets: List[str], lossFn: MetricFnType) -> torch.Tensor:
         lossTargets_ = []
         for target in lossTargets:
-            lossTargets_.append(eval("self." + target))
+            lossTargets_.append(self.resolveTarget(target))
         return lossFn(*lossTargets_, self.params)
 
     def logMetrics(self, loss: torch.Tensor, t: int = 0) -> None:
@@ -87,9 +317,13 @@ class Optimizer:
         return metricDict
 
     def calculateAndLogLoss(self, t: int = 0) -> None:
+        """
+        Returns the loss of every level (a scalar for single level problems)
+        and the logged metrics, where loss is the sum over levels.
+        """
         self.calculateUtility()
         loss = self.applyLoss(self.lossTargets, self.lossFn)
-        metricDict = self.logMetrics(loss, t)
+        metricDict = self.logMetrics(loss.sum(), t)
         return loss, metricDict
 
     def optimize(
@@ -100,29 +334,52 @@ class Optimizer:
         earlyStoppingTolerance: float = 0.00001,
         stop=True,
         optimizer: torch.optim.Optimizer = torch.optim.Adam,
+        reduceProblem: bool = True,
     ) -> bool:
-        converged = False
-        earlyStop = EarlyStopping(tol=earlyStoppingTolerance)
         optim = self.initiateOptimizer(paramsToOptimize, optimizer, lr)
+        if reduceProblem and self.canReduceProblem(paramsToOptimize):
+            self.reducedProblem = self.reduceProblem()
         with torch.no_grad():
             loss, metricDict = self.calculateAndLogLoss(-1)
             resultDict = {
                 "initial_" + metric: metricDict[metric] for metric in metricDict
             }
+        # Per level losses are independent, their sum optimizes all at once
+        # while every level stops on its own loss
+        levels = loss.numel() if self.optimizesFrontier() and loss.ndim == 1 else 1
+        earlyStop = BatchedEarlyStopping(levels, tol=earlyStoppingTolerance)
+        converged = torch.zeros(levels, dtype=torch.bool)
+        levelParams = []
+        if levels > 1 and WEIGHTS_TARGET in paramsToOptimize:
+            levelParams = [self.resolveTarget(WEIGHTS_TARGET)]
 
         for i in tqdm(range(iterations)):
             optim.zero_grad()
             loss, metricDict = self.calculateAndLogLoss(i)
-            loss.backward()
+            loss.sum().backward()
+            if self.portfolio.streaming:
+                self.backwardStreamedUtility()
+            # Stopped levels get no gradient and are restored after steps
+            # that still move them through momentum, as in optimizeBatch
+            for param in levelParams:
+                param.grad[converged] = 0
+            frozen = [param.detach().clone() for param in levelParams]
             optim.step()
-            if earlyStop(loss) and stop:
-                converged = True
-                break
+            with torch.no_grad():
+                for param, values in zip(levelParams, frozen):
+                    param[converged] = values[converged]
+            if stop:
+                converged |= earlyStop(loss.detach().reshape(levels))
+                if converged.all():
+                    break
+        self.reducedProblem = None
         with torch.no_grad():
             loss, metricDict = self.calculateAndLogLoss(i + 1)
             for metric in metricDict:
                 resultDict["final_" + metric] = metricDict[metric]
-            resultDict["converged"] = converged
+            resultDict["converged"] = bool(converged.all())
+            if levels > 1:
+                resultDict["convergedLevels"] = converged.tolist()
             self.optimizationResult = resultDict
         return resultDict
 
@@ -146,6 +403,46 @@ class EarlyStopping:
             return False
 
 
+class BatchedEarlyStopping(EarlyStopping):
+    """
+    EarlyStopping with an independent state per problem of a batch.
+    Returns the mask of problems that stopped improving.
+    """
+
+    def __init__(self, problems: int, patience=20, tol=0.00001):
+        super().__init__(patience, tol)
+        self.best_loss = torch.full((problems,), float("inf"), dtype=torch.float64)
+        self.noImprovement = torch.zeros(problems, dtype=torch.long)
+
+    def __call__(self, losses: torch.Tensor) -> torch.Tensor:
+        improved = losses + self.tol < self.best_loss
+        self.best_loss = torch.where(improved, losses.double(), self.best_loss)
+        self.noImprovement = torch.where(improved, 0, self.noImprovement + 1)
+        return self.noImprovement >= self.patience
+
+
+def pnlUtility(
+    liquidations: torch.Tensor,
+    instrumentX: torch.Tensor,
+    weights: torch.Tensor,
+    prices: torch.Tensor,
+    timeDiscounts: torch.Tensor,
+    moneyUtilityFn: preference.moneyUtilityFnType,
+    params: dict,
+) -> List[torch.Tensor]:
+    revenue = strategy.weightedProfit(liquidations, instrumentX, weights, prices)
+    aggregatedMoney = torch.tensordot(revenue, timeDiscounts.to(revenue.dtype), dims=1)
+    return revenue, moneyUtilityFn(aggregatedMoney, params)
+
+
+def compiledPnLUtility(backend: str = COMPILE_BACKEND) -> Callable:
+    if backend not in compiledPipelines:
+        compiledPipelines[backend] = torch.compile(
+            pnlUtility, backend=backend, dynamic=False
+        )
+    return compiledPipelines[backend]
+
+
 def PortfolioOptimizationLoss(averageUtility, params):
     return -averageUtility
 
@@ -155,24 +452,49 @@ def UtilityEqualizationLoss(averageUtility, params):
     return torch.abs(averageUtility - targetUtility)
 
 
+def compileTarget(target: str) -> Callable[[Any], Any]:
+    """
+    Compiles a target path relative to the optimizer, e.g.
+    "portfolio.strategy.portfolioWeights" or "params['targetUtility']",
+    into a chain of attribute and item lookups, so that resolving it on
+    every iteration needs neither parsing nor eval.
+    """
+    node = ast.parse("self." + target, mode="eval").body
+    steps = []
+    while not isinstance(node, ast.Name):
+        if isinstance(node, ast.Attribute):
+            steps.append(operator.attrgetter(node.attr))
+        elif isinstance(node, ast.Subscript):
+            steps.append(operator.itemgetter(ast.literal_eval(node.slice)))
+        else:
+            raise ValueError("Tofina: unsupported target " + target)
+        node = node.value
+    steps.reverse()
+
+    def accessor(obj):
+        for step in steps:
+            obj = step(obj)
+        return obj
+
+    return accessor
+
+
 def iterateOptimizerParams(optimizer_: Optimizer) -> List[List[str]]:
     lossTargets = []
     optimizationTargets = []
-    queue = [""]
+    # Paths are queued with the objects they lead to, so nothing is
+    # resolved twice
+    queue = [("", optimizer_)]
     while queue:
-        elem = queue.pop()
-        if elem != "":
-            obj = eval("optimizer_" + elem)
-        else:
-            obj = optimizer_
+        elem, obj = queue.pop()
         # Order of if statements matters
         if isinstance(obj, dict):
             for i in obj:
                 if type(i) is str:
-                    queue.append(elem + "['" + i + "']")
+                    queue.append((elem + "['" + i + "']", obj[i]))
                 else:
                     # Else tuple
-                    queue.append(elem + "[" + str(i) + "]")
+                    queue.append((elem + "[" + str(i) + "]", obj[i]))
 
         elif isinstance(obj, torch.nn.parameter.Parameter):
             optimizationTargets.append(elem)
@@ -184,13 +506,16 @@ def iterateOptimizerParams(optimizer_: Optimizer) -> List[List[str]]:
             lossTargets.append(elem)
         else:
             try:
-                for i in vars(obj):
-                    queue.append(elem + "." + i)
+                for i, value in vars(obj).items():
+                    queue.append((elem + "." + i, value))
+                # Properties of the optimizer itself are the registry
+                if isinstance(obj, Optimizer):
+                    continue
                 all_properties = {
                     k: v for k, v in vars(type(obj)).items() if isinstance(v, property)
                 }
                 for i in all_properties:
-                    queue.append(elem + "." + i)
+                    queue.append((elem + "." + i, getattr(obj, i)))
             except:
                 continue
     return utils.removeTrailingSymbol(lossTargets), utils.removeTrailingSymbol(
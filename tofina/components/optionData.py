@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Optional, Union
+from tofina.components.store import contentKey
+from tofina.constants import OPTION_DATA_CACHE_DIRECTORY, OPTION_DATA_CACHE_VERSION
+
+DATE_COLUMNS = ["Date", "Expiry Date"]
+PRICE_COLUMNS = [
+    "Call Last",
+    "Call Bid",
+    "Call Ask",
+    "Put Last",
+    "Put Bid",
+    "Put Ask",
+    "Strike Price",
+    "Underlying Price",
+]
+DATE_FORMAT = "%Y-%m-%d"
+pathType = Union[str, Path]
+
+
+def readOptionCsv(csvPath: pathType) -> pd.DataFrame:
+    """
+    Parses an options CSV of the known schema with explicit dtypes. Padding
+    around fields is skipped by the parser, dates are parsed with a fixed
+    format. Rows are sorted by Date (stably, keeping the order of each day).
+    """
+    df = pd.read_csv(
+        csvPath,
+        usecols=DATE_COLUMNS + PRICE_COLUMNS,
+        dtype={
+            **{column: str for column in DATE_COLUMNS},
+            **dict.fromkeys(PRICE_COLUMNS, np.float64),
+        },
+        skipinitialspace=True,
+    )
+    for column in DATE_COLUMNS:
+        df[column] = pd.to_datetime(df[column].str.strip(), format=DATE_FORMAT)
+    return df.sort_values("Date", kind="stable", ignore_index=True)
+
+
+class OptionDataCache:
+    """
+    Columnar on-disk cache of parsed options CSVs. Every column is one .npy
+    file, loaded memory-mapped, so a date range costs two binary searches on
+    the sorted Date column and reading only the rows in range. Entries are
+    addressed by the CSV path, size and modification time, so an edited CSV
+    is parsed again.
+    """
+
+    def __init__(self, directory: pathType):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, csvPath: pathType) -> str:
+        csvPath = Path(csvPath).resolve()
+        stat = csvPath.stat()
+        return contentKey(
+            OPTION_DATA_CACHE_VERSION, str(csvPath), stat.st_size, stat.st_mtime_ns
+        )
+
+    def path(self, key: str) -> Path:
+        return self.directory / key
+
+    def save(self, key: str, df: pd.DataFrame) -> None:
+        # Columns are written to a temporary directory renamed at the end,
+        # so concurrent runs never see a partially written entry
+        temporaryPath = Path(tempfile.mkdtemp(dir=self.directory))
+        for column in DATE_COLUMNS:
+            np.save(
+                temporaryPath / (column + ".npy"),
+                df[column].values.astype("datetime64[D]"),
+            )
+        for column in PRICE_COLUMNS:
+            np.save(temporaryPath / (column + ".npy"), df[column].values)
+        try:
+            os.rename(temporaryPath, self.path(key))
+        except OSError:
+            shutil.rmtree(temporaryPath)
+
+    def load(
+        self,
+        key: str,
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None,
+    ) -> Optional[pd.DataFrame]:
+        """
+        Rows with start <= Date < end, None if the entry does not exist.
+        """
+        path = self.path(key)
+        if not path.exists():
+            return None
+        columns = {
+            column: np.load(path / (column + ".npy"), mmap_mode="r")
+            for column in DATE_COLUMNS + PRICE_COLUMNS
+        }
+        dates = columns["Date"]
+        first, last = 0, len(dates)
+        if start is not None:
+            first = np.searchsorted(
+                dates, np.datetime64(pd.Timestamp(start), "D"), "left"
+            )
+        if end is not None:
+            last = np.searchsorted(dates, np.datetime64(pd.Timestamp(end), "D"), "left")
+        df = pd.DataFrame(
+            {column: np.array(values[first:last]) for column, values in columns.items()}
+        )
+        for column in DATE_COLUMNS:
+            df[column] = df[column].astype("datetime64[ns]")
+        return df
+
+
+def loadOptionData(
+    csvPath: pathType,
+    start=None,
+    end=None,
+    cacheDirectory: Optional[pathType] = None,
+) -> pd.DataFrame:
+    """
+    Options with start <= Date < end. The CSV is parsed once into an
+    OptionDataCache (by default next to the CSV), later calls read the
+    cache directly.
+    """
+    if cacheDirectory is None:
+        cacheDirectory = Path(csvPath).parent / OPTION_DATA_CACHE_DIRECTORY
+    cache = OptionDataCache(cacheDirectory)
+    key = cache.key(csvPath)
+    df = cache.load(key, start, end)
+    if df is None:
+        cache.save(key, readOptionCsv(csvPath))
+        df = cache.load(key, start, end)
+    return df
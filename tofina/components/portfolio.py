@@ -1,8 +1,15 @@
 import torch
-from tofina.components import asset, instrument, strategy, cache
-from typing import List, Optional, Union, Mapping
+import pandas as pd
+import tofina.utils as utils
+from tofina.components import asset, instrument, strategy, cache, store, arena
+from typing import Iterator, List, Optional, Tuple, Union, Mapping
 from functools import cached_property
-from tofina.constants import ASSET_CACHE_KEY, INSTRUMENT_CACHE_KEY
+from tofina.constants import (
+    ASSET_CACHE_KEY,
+    INSTRUMENT_CACHE_KEY,
+    DEFAULT_SEED,
+    PSEUDO_RANDOM_SAMPLING,
+)
 
 
 class Portfolio:
@@ -12,16 +19,32 @@ class Portfolio:
         monteCarloTrials: int,
         cache_asset: bool = True,
         cache_instrument: bool = True,
+        chunkSize: Optional[int] = None,
+        seed: int = DEFAULT_SEED,
+        sampling: str = PSEUDO_RANDOM_SAMPLING,
+        cache_budget: Optional[cache.CacheBudget] = None,
+        simulationStore: Optional[store.SimulationStore] = None,
     ) -> None:
         self.assets: Mapping[Union[str, List[str]], asset.Asset] = {}
         self.instruments: Mapping[str, instrument.Instrument] = {}
+        # asset name -> (key in self.assets, position in a multi-asset group)
+        self.assetIndex: Mapping[str, Tuple[Union[str, tuple], Optional[int]]] = {}
+        # instrument key -> position in self.instruments and instrumentX
+        self.instrumentIds: Mapping[str, int] = {}
         self.strategy: Optional[strategy.Strategy] = None
         self.processLength = processLength
         self.monteCarloTrials = monteCarloTrials
+        self.chunkSize = chunkSize
+        self.seed = seed
+        self.sampling = sampling
+        self.simulationStore = simulationStore
+        self.assetArena = arena.Arena()
+        self.instrumentArena = arena.Arena()
+        self.cacheBudget = cache_budget
         self.setup_cache(cache_asset, cache_instrument)
 
     def setup_cache(self, cache_asset: bool, cache_instrument: bool):
-        self.caclculationsCache = cache.CalculationCache()
+        self.caclculationsCache = cache.CalculationCache(self.cacheBudget)
         if cache_asset:
             self.caclculationsCache.register_key(ASSET_CACHE_KEY)
         if cache_instrument:
@@ -31,22 +54,37 @@ class Portfolio:
         self, name: Union[str, List[str]], processFn: asset.processFnType, **kwargs
     ) -> None:
         asset_ = asset.Asset(
-            name, processFn, self.processLength, self.monteCarloTrials, **kwargs
+            name,
+            processFn,
+            self.processLength,
+            self.monteCarloTrials,
+            seed=self.seed,
+            sampling=self.sampling,
+            simulationStore=self.simulationStore,
+            **kwargs,
         )
         if type(name) is list:
             name = tuple(name)
+            for position, assetName in enumerate(name):
+                self.assetIndex.setdefault(assetName, (name, position))
+        self.assetIndex[name] = (name, None)
 
         self.assets[name] = asset_
+        self.assetArena.slots = len(self.assets)
 
     def getMonteCarloSimulation(self, assetName: str) -> torch.Tensor:
-        if assetName in self.assets:
-            return self.assets[assetName].monteCarloSimulation
-        else:
-            for assetList in self.assets:
-                if type(assetList) is tuple and assetName in assetList:
-                    position = assetList.index(assetName)
-                    return self.assets[assetList].monteCarloSimulation[position, :, :]
-        raise ValueError("Asset not found")
+        if assetName not in self.assetIndex:
+            raise ValueError("Asset not found")
+        key, position = self.assetIndex[assetName]
+        if position is None:
+            return self.assets[key].monteCarloSimulation
+        return self.assets[key].monteCarloSimulation[position, :, :]
+
+    def registerInstrument(self, key: str, instrument_: instrument.Instrument) -> int:
+        instrumentId = self.instrumentIds.setdefault(key, len(self.instrumentIds))
+        self.instruments[key] = instrument_
+        self.instrumentArena.slots = len(self.instruments)
+        return instrumentId
 
     def addInstrument(
         self,
@@ -65,7 +103,34 @@ class Portfolio:
             price,
             **kwargs,
         )
-        self.instruments[name + "_" + assetName] = instrument_
+        instrumentId = self.registerInstrument(name + "_" + assetName, instrument_)
+        instrument_.placeInArena(self.instrumentArena, instrumentId)
+
+    def addOptionChain(
+        self,
+        assetName: str,
+        name: str,
+        strikePrices: List[float],
+        maturities: List[int],
+        isCall: List[bool],
+        prices: List[float],
+        optionType: str = "American",
+        contractNames: Optional[List[str]] = None,
+    ) -> instrument.OptionChain:
+        optionChain = instrument.OptionChain(
+            name,
+            assetName,
+            self.getMonteCarloSimulation(assetName),
+            strikePrices,
+            maturities,
+            isCall,
+            prices,
+            optionType,
+            contractNames,
+        )
+        for contract in optionChain.contracts:
+            self.registerInstrument(contract.name + "_" + assetName, contract)
+        return optionChain
 
     @property
     def num_instruments(self):
@@ -81,37 +146,95 @@ class Portfolio:
             portfolioWeights,
             liquidationFn,
             self.instruments,
+            cache_budget=self.cacheBudget,
             **kwargs,
         )
 
+    def cacheStatsReport(self) -> pd.DataFrame:
+        caches = {"portfolio": self.caclculationsCache}
+        if self.strategy is not None:
+            caches["strategy"] = self.strategy.calculationsCache
+        return pd.concat(
+            [cache_.stats_report() for cache_ in caches.values()], keys=list(caches)
+        )
+
     def setPortfolioWeights(self, *args, **kwargs) -> None:
         self.strategy.setPortfolioWeights(*args, **kwargs)
 
     @property
     def assetX(self) -> torch.Tensor:
         def assetX_(self):
-            return torch.stack(
+            return self.assetArena.gather(
                 [self.assets[asset_].monteCarloSimulation for asset_ in self.assets]
             )
 
-        return self.caclculationsCache(assetX_, ASSET_CACHE_KEY)(self)
+        def dependencies():
+            return [asset_.monteCarloSimulation for asset_ in self.assets.values()]
+
+        return self.caclculationsCache(assetX_, ASSET_CACHE_KEY, dependencies)(self)
 
     @property
     def instrumentX(self) -> torch.Tensor:
         def instrumentX_(self):
-            return torch.stack(
+            return self.instrumentArena.gather(
                 [instrument.revenue for instrument in self.instruments.values()]
             )
 
-        return self.caclculationsCache(instrumentX_, INSTRUMENT_CACHE_KEY)(self)
+        def dependencies():
+            return [instrument_.revenue for instrument_ in self.instruments.values()]
+
+        return self.caclculationsCache(
+            instrumentX_, INSTRUMENT_CACHE_KEY, dependencies
+        )(self)
 
-    def regenerateAllAssetsAndInstruments(self, monteCarloTrials: int = None):
+    def controlVariates(self) -> Optional[torch.Tensor]:
+        """
+        Deviations of simulated asset values from their known expectations,
+        shaped (trials x controls). Assets without a closed-form expectation,
+        the deterministic initial period and riskless assets are skipped.
+        Controls are capped to one per TRIALS_PER_CONTROL_VARIATE trials,
+        latest periods first since they explain most of the final wealth.
+        """
+        controls = []
         for asset_ in self.assets.values():
-            asset_.monteCarloSimulation = asset_.simulate(monteCarloTrials)
+            expectation = asset_.expectation()
+            if expectation is None:
+                continue
+            deviation = asset_.monteCarloSimulation - expectation.unsqueeze(-2)
+            if len(deviation.shape) == 3:
+                deviation = deviation.permute(1, 0, 2)
+            trials = deviation.shape[0]
+            controls.append(deviation.reshape(trials, -1, self.processLength)[..., 1:])
+        if len(controls) == 0:
+            return None
+        controls = torch.cat(controls, dim=1).flip(-1).transpose(1, 2).flatten(1)
+        if controls.shape[0] < 2:
+            return None
+        controls = controls[:, controls.detach().std(axis=0) > 0]
+        controls = controls[:, : controls.shape[0] // utils.TRIALS_PER_CONTROL_VARIATE]
+        return controls if controls.shape[1] > 0 else None
+
+    def refresh(self) -> None:
+        """
+        Propagates changes along asset params -> simulation -> instrument
+        revenue. Simulations and revenues are lazy and versioned, so only
+        assets whose params changed are re-simulated and only instruments on
+        those assets recompute revenue, on first access. Strategy tensors
+        follow through their versioned caches.
+        """
+        simulations = {}
         for instrument_ in self.instruments.values():
-            instrument_.updateAssetSimulation(
-                self.getMonteCarloSimulation(instrument_.assetName)
-            )
+            assetName = instrument_.assetName
+            if assetName not in simulations:
+                simulations[assetName] = self.getMonteCarloSimulation(assetName)
+            instrument_.updateAssetSimulation(simulations[assetName])
+
+    def regenerateAllAssetsAndInstruments(
+        self, monteCarloTrials: int = None, chunkIndex: int = 0
+    ):
+        for asset_ in self.assets.values():
+            asset_.monteCarloSimulation = asset_.simulate(monteCarloTrials, chunkIndex)
+        self.refresh()
 
     def regenerateAssetsAndInstrumentsWithRealData(
         self, assetDict: Mapping[str, torch.Tensor]
@@ -123,18 +246,66 @@ class Portfolio:
                 self.assets[assetName].monteCarloSimulation = self.assets[
                     assetName
                 ].simulate(1)
-
-        for instrument_ in self.instruments.values():
-            instrument_.updateAssetSimulation(
-                self.getMonteCarloSimulation(instrument_.assetName)
-            )
+        self.refresh()
 
     def assetsAndInstruments(self):
-        useStale = self.caclculationsCache.use_stale_assets_and_instruments()
-        if not useStale:
+        if self.caclculationsCache.use_stale_assets_and_instruments():
+            self.refresh()
+        else:
             self.regenerateAllAssetsAndInstruments()
         return self.assetX, self.instrumentX
 
+    @property
+    def streaming(self) -> bool:
+        return self.chunkSize is not None
+
+    def chunkTrials(self) -> List[int]:
+        fullChunks, remainder = divmod(self.monteCarloTrials, self.chunkSize)
+        return [self.chunkSize] * fullChunks + ([remainder] if remainder else [])
+
+    def simulationChunks(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Streaming execution mode. Simulates trials in chunks of chunkSize so
+        that only one chunk of (trials x horizon x instruments) intermediates
+        is alive at a time. Each chunk is seeded by its index, so repeated
+        passes see the same trials.
+        """
+        for chunkIndex, monteCarloTrials in enumerate(self.chunkTrials()):
+            # Fresh arenas per chunk, graphs of earlier chunks may still
+            # hold the previous buffers
+            self.assetArena.release()
+            self.instrumentArena.release()
+            self.regenerateAllAssetsAndInstruments(monteCarloTrials, chunkIndex)
+            yield self.assetX, self.instrumentX
+
+    def simulatePnLChunks(self) -> Iterator[torch.Tensor]:
+        for assetX, instrumentX in self.simulationChunks():
+            yield self.strategy.estimateProfit(assetX, instrumentX)
+
     def simulatePnL(self) -> torch.Tensor:
+        if self.streaming:
+            return torch.cat(list(self.simulatePnLChunks()), dim=-2)
         assetX, instrumentX = self.assetsAndInstruments()
         return self.strategy.estimateProfit(assetX, instrumentX)
+
+    def simulateBatchedPnL(self, candidateWeights: torch.Tensor) -> torch.Tensor:
+        """
+        PnL of many candidate weight vectors at once, see
+        Strategy.batchedProfit. Returns (candidates x trials x horizon).
+        """
+        if self.streaming:
+            return torch.cat(
+                [
+                    self.strategy.batchedProfit(assetX, instrumentX, candidateWeights)
+                    for assetX, instrumentX in self.simulationChunks()
+                ],
+                dim=1,
+            )
+        assetX, instrumentX = self.assetsAndInstruments()
+        return self.strategy.batchedProfit(assetX, instrumentX, candidateWeights)
+
+    def simulateReducedPnL(
+        self, periodWeights: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        assetX, instrumentX = self.assetsAndInstruments()
+        return self.strategy.reducedProfitMatrix(assetX, instrumentX, periodWeights)
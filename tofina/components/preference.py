@@ -1,12 +1,18 @@
 import tofina.utils as utils
 import torch
-from typing import Callable
+from typing import Callable, Optional, Union
 
 moneyUtilityFnType = Callable[[torch.tensor, dict], torch.Tensor]
-timeDiscountFnType = Callable[[int, dict], float]
+timeDiscountFnType = Callable[[Union[int, torch.Tensor], dict], float]
 
 
 class Preference:
+    """
+    Params may be vectors, e.g. RiskAversion=[0.5, 1.5, 3.0], in which case
+    utilities are returned per level (broadcast shape of all params) from
+    one pass over the money tensor.
+    """
+
     def __init__(
         self,
         moneyUtilityFn: moneyUtilityFnType,
@@ -16,22 +22,121 @@ class Preference:
         self.moneyUtilityFn = moneyUtilityFn
         self.timeDiscountFn = timeDiscountFn
         self.params = utils.convertKwargsToTorchParameters(kwargs)
+        self.discountCache = {}
+
+    def __getstate__(self) -> dict:
+        # Cached discounts are keyed by weak references, rebuilt on demand
+        state = self.__dict__.copy()
+        state["discountCache"] = {}
+        return state
+
+    @property
+    def levels(self) -> torch.Size:
+        return torch.broadcast_shapes(*(param.shape for param in self.params.values()))
+
+    def timeDiscounts(self, processLength: int) -> torch.Tensor:
+        """
+        (processLength x *levels) discount factors, cached per horizon until
+        a param is replaced or modified in place. Discounts tracked by
+        autograd (e.g. optimized interestRate) are recomputed on every call,
+        so each backward pass gets its own graph.
+        """
+        versions = utils.tensorVersions(self.params)
+        tracksGrad, _ = versions
+        cached = self.discountCache.get(processLength)
+        if cached is not None and utils.versionsMatch(cached[0], versions):
+            return cached[1]
+        timeDiscounts = self.evaluateTimeDiscounts(processLength)
+        if not tracksGrad:
+            self.discountCache[processLength] = (versions, timeDiscounts)
+        return timeDiscounts
+
+    def evaluateTimeDiscounts(self, processLength: int) -> torch.Tensor:
+        """
+        Evaluates timeDiscountFn once over a (processLength x 1 ...) period
+        tensor. Functions that only accept an integer period are evaluated
+        period by period.
+        """
+        levels = self.levels
+        shape = (processLength, *levels)
+        periods = torch.arange(1, processLength + 1).reshape(
+            processLength, *[1] * len(levels)
+        )
+        try:
+            timeDiscounts = torch.as_tensor(self.timeDiscountFn(periods, self.params))
+            return timeDiscounts.broadcast_to(shape)
+        except (RuntimeError, TypeError, ValueError):
+            timeDiscounts = [
+                torch.as_tensor(self.timeDiscountFn(i, self.params)).broadcast_to(
+                    levels
+                )
+                for i in range(1, processLength + 1)
+            ]
+            return torch.stack(timeDiscounts)
+
+    def aggregatedMoney(self, moneyX: torch.Tensor) -> torch.Tensor:
+        """
+        Discounted sum over the horizon (last axis of moneyX), followed by
+        one axis per level.
+        """
+        timeDiscounts = self.timeDiscounts(moneyX.shape[-1]).to(moneyX.dtype)
+        return torch.tensordot(moneyX, timeDiscounts, dims=1)
+
+    def aggregatedUtility(
+        self,
+        aggregatedMoney: torch.Tensor,
+        controlVariates: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        utilities = self.moneyUtilityFn(aggregatedMoney, self.params)
+        if controlVariates is not None:
+            utilities = utils.controlVariateAdjustment(utilities, controlVariates)
+        return utilities.mean(axis=0)
+
+    def utility(
+        self, moneyX: torch.Tensor, controlVariates: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        return self.aggregatedUtility(self.aggregatedMoney(moneyX), controlVariates)
+
+    def batchedUtility(
+        self, moneyX: torch.Tensor, controlVariates: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Utility of every candidate in (candidates x trials x horizon) money.
+        Control variate coefficients are fitted per candidate.
+        Returns (candidates x *levels).
+        """
+        utilities = self.moneyUtilityFn(self.aggregatedMoney(moneyX), self.params)
+        if controlVariates is not None:
+            utilities = utils.controlVariateAdjustment(
+                utilities.movedim(1, 0), controlVariates
+            ).movedim(0, 1)
+        return utilities.mean(axis=1)
 
-    def utility(self, moneyX: torch.Tensor) -> torch.Tensor:
-        processLength = moneyX.shape[-1]
-        timeDiscounts = [
-            self.timeDiscountFn(i, self.params) for i in range(1, processLength + 1)
-        ]
-        timeDiscounts = torch.tensor(timeDiscounts)
-        aggregatedMoney = (moneyX * timeDiscounts).sum(axis=1)
-        return self.moneyUtilityFn(aggregatedMoney, self.params).mean()
+    def frontierUtility(
+        self, moneyX: torch.Tensor, controlVariates: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Utility of (levels x trials x horizon) money, every row evaluated at
+        its own level only. Single level preferences are broadcast, other
+        preferences need one row per level.
+        """
+        levels, _, processLength = moneyX.shape
+        if self.levels.numel() > 1 and self.levels != (levels,):
+            raise ValueError(
+                f"Tofina: preference levels {tuple(self.levels)} need one row of "
+                f"money per level, got {levels}"
+            )
+        timeDiscounts = self.timeDiscounts(processLength).to(moneyX.dtype)
+        timeDiscounts = timeDiscounts.broadcast_to((processLength, levels))
+        aggregatedMoney = torch.einsum("lth,hl->tl", moneyX, timeDiscounts)
+        return self.aggregatedUtility(aggregatedMoney, controlVariates)
 
 
-def InterestRateTimeDiscount(time: int, params: dict) -> float:
+def InterestRateTimeDiscount(time: Union[int, torch.Tensor], params: dict) -> float:
     return 1 / ((1 + params["interestRate"]) ** time)
 
 
-def NoTimeDiscount(time: int, params: dict) -> float:
+def NoTimeDiscount(time: Union[int, torch.Tensor], params: dict) -> float:
     return 1
 
 
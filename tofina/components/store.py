@@ -0,0 +1,204 @@
+import os
+import types
+import hashlib
+import tempfile
+import functools
+import numpy as np
+import torch
+from pathlib import Path
+from typing import Optional, Union
+from tofina.constants import SIMULATION_STORE_ENV, SIMULATION_STORE_VERSION
+
+PLAIN_VALUE_TYPES = (
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    type(None),
+    tuple,
+    frozenset,
+    torch.Tensor,
+    np.ndarray,
+)
+
+
+class UnkeyableError(ValueError):
+    pass
+
+
+def describe(value) -> str:
+    """
+    Stable, content based description of process functions and their
+    params, used to address stored simulations. Functions are described by
+    their qualified name, code (see describeCode), closure, defaults and
+    referenced globals, tensors and arrays by a hash of their data. Objects
+    without a stable description (e.g. repr with a memory address) raise
+    UnkeyableError unless they define storeKey.
+    """
+    storeKey = getattr(value, "storeKey", None)
+    if storeKey is not None:
+        return "key:" + str(storeKey)
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return f"array:{value.dtype}:{value.shape}:{digest}"
+    if isinstance(value, dict):
+        items = sorted((describe(key), describe(val)) for key, val in value.items())
+        return "{" + ",".join(key + ":" + val for key, val in items) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(describe(item) for item in value) + "]"
+    if isinstance(value, functools.partial):
+        return "partial:" + describe([value.func, value.args, value.keywords])
+    code = getattr(value, "__code__", None)
+    if code is not None:
+        closure = [cell.cell_contents for cell in value.__closure__ or []]
+        return ":".join(
+            [
+                "function",
+                value.__module__,
+                value.__qualname__,
+                describeCode(code),
+                describe([closure, value.__defaults__, value.__kwdefaults__]),
+                describeGlobals(value, code, {id(value)}),
+            ]
+        )
+    text = repr(value)
+    if " at 0x" in text:
+        raise UnkeyableError(f"{type(value).__name__} has no stable description")
+    return type(value).__qualname__ + ":" + text
+
+
+def describeConstant(value) -> str:
+    if isinstance(value, types.CodeType):
+        return describeCode(value)
+    if isinstance(value, (tuple, frozenset)):
+        items = [describeConstant(item) for item in value]
+        if isinstance(value, frozenset):
+            items.sort()
+        return type(value).__name__ + "(" + ",".join(items) + ")"
+    return repr(value)
+
+
+def describeCode(code: types.CodeType) -> str:
+    """
+    Hash of bytecode, constants (nested code objects included) and names,
+    so functions differing only in a literal or a referenced name differ.
+    """
+    description = [
+        code.co_code.hex(),
+        describeConstant(code.co_consts),
+        repr(code.co_names),
+    ]
+    return hashlib.sha256("|".join(description).encode()).hexdigest()
+
+
+def codeNames(code: types.CodeType) -> set:
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names |= codeNames(constant)
+    return names
+
+
+def describeGlobals(function, code: types.CodeType, visited: set) -> str:
+    """
+    Module globals referenced by a function. Modules and classes are
+    described by name, plain values, tensors and arrays by value, other
+    objects (e.g. mutable bookkeeping) only by type. Functions are described
+    by name, code and their own referenced globals, so editing a helper
+    changes the description of every function calling it. Functions already
+    being described (visited, by id) are referenced by name only, which
+    keeps recursive functions finite.
+    """
+    namespace = getattr(function, "__globals__", {})
+    described = []
+    for name in sorted(codeNames(code)):
+        if name not in namespace:
+            continue
+        value = namespace[name]
+        if isinstance(value, types.ModuleType):
+            description = "module:" + value.__name__
+        elif isinstance(value, type):
+            description = "class:" + value.__module__ + "." + value.__qualname__
+        elif isinstance(getattr(value, "__code__", None), types.CodeType):
+            description = value.__module__ + ":" + value.__qualname__
+            if id(value) not in visited:
+                visited.add(id(value))
+                description += ":" + describeCode(value.__code__)
+                description += ":" + describeGlobals(value, value.__code__, visited)
+        elif isinstance(value, PLAIN_VALUE_TYPES):
+            description = describe(value)
+        else:
+            description = "object:" + type(value).__qualname__
+        described.append(name + "=" + description)
+    return "globals[" + ",".join(described) + "]"
+
+
+def contentKey(*values) -> str:
+    return hashlib.sha256(describe(list(values)).encode()).hexdigest()
+
+
+class SimulationStore:
+    """
+    Content addressed on-disk store of Monte Carlo simulations. Every
+    simulation is one .npy file named after the hash of everything that
+    determines it, loaded back memory-mapped (copy-on-write), so reuse
+    costs neither simulation nor a copy.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(
+        self,
+        name,
+        processFn,
+        params: dict,
+        seed: int,
+        sampling: str,
+        processLength: int,
+        monteCarloTrials: int,
+        chunkIndex: int = 0,
+    ) -> Optional[str]:
+        try:
+            return contentKey(
+                SIMULATION_STORE_VERSION,
+                name,
+                processFn,
+                params,
+                seed,
+                sampling,
+                processLength,
+                monteCarloTrials,
+                chunkIndex,
+            )
+        except UnkeyableError:
+            return None
+
+    def path(self, key: str) -> Path:
+        return self.directory / (key + ".npy")
+
+    def load(self, key: str) -> Optional[torch.Tensor]:
+        path = self.path(key)
+        if not path.exists():
+            return None
+        return torch.from_numpy(np.load(path, mmap_mode="c"))
+
+    def save(self, key: str, simulation: torch.Tensor) -> None:
+        # Written to a temporary file first so that concurrent runs never
+        # see a partially written simulation
+        handle, temporaryPath = tempfile.mkstemp(dir=self.directory, suffix=".npy")
+        with os.fdopen(handle, "wb") as file:
+            np.save(file, simulation.detach().cpu().numpy())
+        os.replace(temporaryPath, self.path(key))
+
+
+def defaultStore() -> Optional[SimulationStore]:
+    directory = os.environ.get(SIMULATION_STORE_ENV)
+    if not directory:
+        return None
+    return SimulationStore(directory)
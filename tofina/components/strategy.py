@@ -1,6 +1,6 @@
 import torch
 import tofina.utils as utils
-from typing import List, Callable, Mapping
+from typing import List, Callable, Mapping, Optional
 from tofina.components import instrument, cache
 from tofina.constants import (
     LIQUIDATIONS_CACHE_KEY,
@@ -9,6 +9,8 @@ from tofina.constants import (
 )
 
 instrumentsDictType = Mapping[str, instrument.Instrument]
+NO_MATURITY = 2**62
+FUSED_PROFIT_CHUNK = 32
 liquidationFnType = Callable[[torch.Tensor, instrumentsDictType, dict], torch.Tensor]
 
 
@@ -20,6 +22,7 @@ class Strategy:
         instruments: instrumentsDictType,
         cache_liquidations: bool = False,
         cache_returns: bool = False,
+        cache_budget: Optional[cache.CacheBudget] = None,
         **kwargs
     ) -> None:
         self.liquidationFn = liquidationFn
@@ -28,10 +31,15 @@ class Strategy:
         self.softmax = torch.nn.Softmax(dim=0)
         self.setPortfolioWeights(portfolioWeights)
         self.params = utils.convertKwargsToTorchParameters(kwargs)
-        self.setup_cache(cache_liquidations, cache_returns)
+        self.setup_cache(cache_liquidations, cache_returns, cache_budget)
 
-    def setup_cache(self, cache_liquidations: bool, cache_returns: bool):
-        self.calculationsCache = cache.CalculationCache()
+    def setup_cache(
+        self,
+        cache_liquidations: bool,
+        cache_returns: bool,
+        cache_budget: Optional[cache.CacheBudget] = None,
+    ):
+        self.calculationsCache = cache.CalculationCache(cache_budget)
         if cache_liquidations:
             self.calculationsCache.register_key(LIQUIDATIONS_CACHE_KEY)
         if cache_returns:
@@ -41,7 +49,7 @@ class Strategy:
 
     @property
     def normalizedWeights(self) -> torch.Tensor:
-        return self.portfolioWeights.abs() / self.portfolioWeights.abs().sum()
+        return normalizeWeights(self.portfolioWeights)
 
     def setPortfolioWeights(self, portfolioWeights: List[float]) -> None:
         if type(portfolioWeights) is not torch.Tensor:
@@ -59,34 +67,64 @@ class Strategy:
         backroll = (1 - liquidations).cumprod(axis=2)
         return liquidations[:, :, 1:] * backroll[:, :, :-1]
 
+    def instrumentMaturities(self) -> torch.Tensor:
+        """
+        Maturity of every instrument, NO_MATURITY for instruments without one.
+        Only evaluated inside liquidations, whose cache depends on instrument
+        params, so changed or replaced instruments are always picked up.
+        """
+        return torch.tensor(
+            [
+                (
+                    int(instrument_.params["maturity"])
+                    if "maturity" in instrument_.params
+                    else NO_MATURITY
+                )
+                for instrument_ in self.instruments.values()
+            ],
+            dtype=torch.long,
+        )
+
     def liquidations(self, assetX: torch.Tensor) -> torch.Tensor:
         def liquidations_(self, assetX: torch.Tensor) -> torch.Tensor:
+            # Liquidation functions may return a (instruments x 1 x horizon)
+            # schedule when it is the same for every trial, it then
+            # broadcasts over trials instead of being materialized per trial
             liquidations = self.liquidationFn(assetX, self.instruments, self.params)
             liquidations[:, :, -1] = 1
             liquidations[:, :, 0] = 0
             _, _, processLength = liquidations.shape
-            for i, key in enumerate(self.instruments):
-                if (
-                    "maturity" in self.instruments[key].params
-                    and self.instruments[key].params["maturity"] <= processLength
-                ):
-                    liquidations[i, :, self.instruments[key].params["maturity"] - 1] = 1
+            maturities = self.instrumentMaturities()
+            (maturing,) = torch.nonzero(maturities <= processLength, as_tuple=True)
+            liquidations[maturing, :, maturities[maturing] - 1] = 1
             liquidations = self.backrollLiquidations(liquidations).permute(1, 2, 0)
             return liquidations
 
-        return self.calculationsCache(liquidations_, LIQUIDATIONS_CACHE_KEY)(
-            self, assetX
-        )
+        return self.calculationsCache(
+            liquidations_, LIQUIDATIONS_CACHE_KEY, self.liquidationDependencies
+        )(self, assetX)
+
+    def liquidationDependencies(self) -> list:
+        return [self.params] + [
+            instrument_.params for instrument_ in self.instruments.values()
+        ]
+
+    def returnDependencies(self) -> list:
+        return [instrument_.price for instrument_ in self.instruments.values()]
+
+    @property
+    def prices(self) -> torch.Tensor:
+        return torch.cat([instrument.price for instrument in self.instruments.values()])
 
     def returns(self, instrumentX: torch.Tensor) -> torch.Tensor:
         def returns_(self, instrumentX: torch.Tensor) -> torch.Tensor:
-            prices = torch.cat(
-                [instrument.price for instrument in self.instruments.values()]
-            )
+            prices = self.prices
             returns = (instrumentX.permute(1, 2, 0) - prices) / prices
             return returns
 
-        return self.calculationsCache(returns_, RETURNS_CACHE_KEY)(self, instrumentX)
+        return self.calculationsCache(
+            returns_, RETURNS_CACHE_KEY, self.returnDependencies
+        )(self, instrumentX)
 
     def effectiveReturns(
         self, assetX: torch.Tensor, instrumentX: torch.Tensor
@@ -98,25 +136,105 @@ class Strategy:
             returns = self.returns(instrumentX)
             return liquidations * returns[:, 1:, :]
 
-        return self.calculationsCache(effectiveReturns_, EFFECTIVE_RETURNS_CACHE_KEY)(
-            self, assetX, instrumentX
-        )
+        def dependencies():
+            return [self.liquidationDependencies(), self.returnDependencies()]
+
+        return self.calculationsCache(
+            effectiveReturns_, EFFECTIVE_RETURNS_CACHE_KEY, dependencies
+        )(self, assetX, instrumentX)
 
     def estimateProfit(
         self, assetX: torch.Tensor, instrumentX: torch.Tensor
     ) -> torch.Tensor:
+        if self.portfolioWeights.ndim > 1:
+            return self.batchedProfit(assetX, instrumentX, self.portfolioWeights)
+        if EFFECTIVE_RETURNS_CACHE_KEY not in self.calculationsCache.allowed_keys:
+            return self.fusedProfit(assetX, instrumentX)
         effectiveReturns = self.effectiveReturns(assetX, instrumentX)
         return (self.normalizedWeights * effectiveReturns).sum(axis=2)
 
+    def fusedProfit(
+        self, assetX: torch.Tensor, instrumentX: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Weighted PnL without materializing returns or effective returns:
+        sum_i w_i * l_nti * (X_int - p_i) / p_i
+            = sum_i l_nti * (w_i / p_i) * X_int - sum_i l_nti * w_i
+        instrumentX is contracted in its own (instruments x trials x horizon)
+        layout, a few instruments at a time, so intermediates stay bounded.
+        Used when effective returns are not cached, e.g. while prices or
+        process params are being optimized.
+        """
+        return weightedProfit(
+            self.liquidations(assetX), instrumentX, self.normalizedWeights, self.prices
+        )
+
+    def batchedProfit(
+        self,
+        assetX: torch.Tensor,
+        instrumentX: torch.Tensor,
+        candidateWeights: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Profit of every row of a (candidates x instruments) weight matrix,
+        normalized like portfolioWeights, as (candidates x trials x horizon).
+        Effective returns are computed once and shared by all candidates.
+        """
+        effectiveReturns = self.effectiveReturns(assetX, instrumentX)
+        candidateWeights = torch.as_tensor(
+            candidateWeights, dtype=effectiveReturns.dtype
+        )
+        return (effectiveReturns @ normalizeWeights(candidateWeights).T).permute(
+            2, 0, 1
+        )
+
+    def reducedProfitMatrix(
+        self,
+        assetX: torch.Tensor,
+        instrumentX: torch.Tensor,
+        periodWeights: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Collapses effective returns over the horizon into a
+        (trials x instruments) matrix. Profit is linear in normalizedWeights,
+        so aggregated profit equals reducedProfitMatrix @ normalizedWeights.
+        """
+        effectiveReturns = self.effectiveReturns(assetX, instrumentX)
+        if periodWeights is None:
+            return effectiveReturns.sum(axis=1)
+        return (effectiveReturns * periodWeights.unsqueeze(-1)).sum(axis=1)
+
+
+def normalizeWeights(weights: torch.Tensor) -> torch.Tensor:
+    return weights.abs() / weights.abs().sum(axis=-1, keepdim=True)
+
+
+def weightedProfit(
+    liquidations: torch.Tensor,
+    instrumentX: torch.Tensor,
+    weights: torch.Tensor,
+    prices: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Tensor-only part of Strategy.fusedProfit, free of Python state so that
+    it can also be traced by torch.compile.
+    """
+    scaledLiquidations = (liquidations * (weights / prices)).permute(2, 0, 1)
+    payouts = instrumentX[:, :, 1:]
+    profit = -(liquidations @ weights)
+    for start in range(0, payouts.shape[0], FUSED_PROFIT_CHUNK):
+        end = start + FUSED_PROFIT_CHUNK
+        profit = profit + (payouts[start:end] * scaledLiquidations[start:end]).sum(0)
+    return profit
+
 
 def BuyAndHold(
     Xt: torch.Tensor, instruments: instrumentsDictType, params: dict
 ) -> torch.Tensor:
     instrumentsNum = len(instruments)
     processLength = Xt.shape[-1]
-    monteCarloTrials = Xt.shape[-2]
 
-    liquidations = torch.zeros((instrumentsNum, monteCarloTrials, processLength))
+    liquidations = torch.zeros((instrumentsNum, 1, processLength))
     liquidations[:, :, -1] = 1
     return liquidations
 
@@ -126,8 +244,7 @@ def UniformLiquidation(
 ) -> torch.Tensor:
     instrumentsNum = len(instruments)
     processLength = Xt.shape[-1]
-    monteCarloTrials = Xt.shape[-2]
-    liquidations = torch.zeros((instrumentsNum, monteCarloTrials, processLength))
+    liquidations = torch.zeros((instrumentsNum, 1, processLength))
     liquidations[:, :, :] = 1 / processLength
     liquidations[:, :, -1] = 1
     return liquidations
@@ -3,3 +3,11 @@ INSTRUMENT_CACHE_KEY = "instrument_cache"
 LIQUIDATIONS_CACHE_KEY = "liquidations_cache"
 RETURNS_CACHE_KEY = "returns_cache"
 EFFECTIVE_RETURNS_CACHE_KEY = "effective_returns_cache"
+DEFAULT_SEED = 123
+PSEUDO_RANDOM_SAMPLING = "pseudo"
+ANTITHETIC_SAMPLING = "antithetic"
+SOBOL_SAMPLING = "sobol"
+SIMULATION_STORE_ENV = "TOFINA_SIMULATION_STORE"
+SIMULATION_STORE_VERSION = 1
+OPTION_DATA_CACHE_DIRECTORY = ".optionDataCache"
+OPTION_DATA_CACHE_VERSION = 1
@@ -1,5 +1,9 @@
+import functools
+import numpy as np
 import torch
 from arch import arch_model
+from tofina.components.store import contentKey
+from tofina.constants import DEFAULT_SEED
 
 
 def prepend_tensor_with_ones(tensor: torch.Tensor) -> torch.Tensor:
@@ -7,25 +11,39 @@ def prepend_tensor_with_ones(tensor: torch.Tensor) -> torch.Tensor:
     return torch.cat((ones, tensor), 2)
 
 
-def forecastDecoratorGARCH(df, split_date, horizon=20, simulations=1000, **arch_kwargs):
+def forecastDecoratorGARCH(
+    df, split_date, horizon=20, simulations=1000, seed=DEFAULT_SEED, **arch_kwargs
+):
+    """
+    The model is fitted and simulated (from seed) on the first forecast, so
+    forecasts found in the simulation store never refit. Call forecast.fit()
+    before forking backtest workers to share a single fit.
+    """
     df = df.copy()
 
     df["diff"] = 100 * df["Close"].diff() / df["Close"].shift(1)
     df = df.dropna()
     ts = df["diff"]
-    am = arch_model(ts, **arch_kwargs)
-    res = am.fit(update_freq=5, last_obs=split_date)
-    simulation = res.forecast(
-        method="simulation", horizon=horizon - 1, simulations=simulations
-    )
-    simulation_values = 1 + simulation.simulations.values / 100
-    simulation_values = simulation_values.cumprod(axis=2)
-    simulation_values = torch.from_numpy(simulation_values)
-    simulation_values = prepend_tensor_with_ones(simulation_values)
-    init_values = torch.from_numpy(df["Close"].values)
-    simulation_values = (simulation_values.permute(1, 2, 0) * init_values).permute(
-        2, 0, 1
-    )
+
+    @functools.lru_cache(maxsize=None)
+    def fit():
+        am = arch_model(ts, **arch_kwargs)
+        res = am.fit(update_freq=5, last_obs=split_date)
+        simulation = res.forecast(
+            method="simulation",
+            horizon=horizon - 1,
+            simulations=simulations,
+            random_state=np.random.RandomState(seed),
+        )
+        simulation_values = 1 + simulation.simulations.values / 100
+        simulation_values = simulation_values.cumprod(axis=2)
+        simulation_values = torch.from_numpy(simulation_values)
+        simulation_values = prepend_tensor_with_ones(simulation_values)
+        init_values = torch.from_numpy(df["Close"].values)
+        simulation_values = (simulation_values.permute(1, 2, 0) * init_values).permute(
+            2, 0, 1
+        )
+        return simulation, simulation_values
 
     def forecast(
         date: str,
@@ -36,7 +54,19 @@ def forecastDecoratorGARCH(df, split_date, horizon=20, simulations=1000, **arch_
     ):
         assert processLength == horizon
         assert monteCarloTrials == simulations
+        simulation, simulation_values = fit()
         index = simulation.mean.index.get_loc(date)
         return simulation_values[index, :, :]
 
+    # Fitted forecasts are addressed by their inputs in the simulation store
+    forecast.storeKey = contentKey(
+        "GARCH",
+        df["Close"].values,
+        str(split_date),
+        horizon,
+        simulations,
+        seed,
+        arch_kwargs,
+    )
+    forecast.fit = fit
     return forecast
@@ -13,8 +13,11 @@ from lightning.pytorch.callbacks import EarlyStopping
 import matplotlib.pyplot as plt
 from pytorch_lightning import loggers as pl_loggers
 from typing import Dict
+import functools
 import numpy as np
 import torch
+from tofina.components.store import contentKey
+from tofina.constants import DEFAULT_SEED
 
 
 def preprocess_df_dict(df_dict: Dict[str, pd.DataFrame]):
@@ -126,7 +129,13 @@ def forecastDecoratorDeepAR(
     simulations=1000,
     max_encoder_length=30,
     max_epochs=30,
+    seed=DEFAULT_SEED,
 ):
+    """
+    The network is trained and sampled (from seed) on the first forecast,
+    so forecasts found in the simulation store never refit. Call
+    forecast.fit() before forking backtest workers to share a single fit.
+    """
 
     data = preprocess_df_dict(df_dict)
     date_timeidx = date_timeidx_map(data)
@@ -135,34 +144,39 @@ def forecastDecoratorDeepAR(
 
     context_length = max_encoder_length
     prediction_length = max_prediction_length
-    training, validation, train_dataloader, val_dataloader = get_dataloaders(
-        data,
-        training_cutoff,
-        context_length,
-        prediction_length - 1,
-    )
-    trainer = fit_model(
-        training,
-        train_dataloader,
-        val_dataloader,
-        log_dict=log_dict,
-        max_epochs=max_epochs,
-    )
-    best_model_path = trainer.checkpoint_callback.best_model_path
-    best_model = DeepAR.load_from_checkpoint(best_model_path)
-    simulation = best_model.predict(
-        val_dataloader,
-        return_index=True,
-        mode="samples",
-        n_samples=simulations,
-        trainer_kwargs=dict(accelerator="cpu"),
-    )
+
+    @functools.lru_cache(maxsize=None)
+    def fit():
+        pl.seed_everything(seed, workers=True)
+        training, validation, train_dataloader, val_dataloader = get_dataloaders(
+            data,
+            training_cutoff,
+            context_length,
+            prediction_length - 1,
+        )
+        trainer = fit_model(
+            training,
+            train_dataloader,
+            val_dataloader,
+            log_dict=log_dict,
+            max_epochs=max_epochs,
+        )
+        best_model_path = trainer.checkpoint_callback.best_model_path
+        best_model = DeepAR.load_from_checkpoint(best_model_path)
+        return best_model.predict(
+            val_dataloader,
+            return_index=True,
+            mode="samples",
+            n_samples=simulations,
+            trainer_kwargs=dict(accelerator="cpu"),
+        )
 
     def forecast(
         date: str, asset, processLength=horizon, monteCarloTrials=simulations, **params
     ):
         assert processLength == horizon
         assert monteCarloTrials == simulations
+        simulation = fit()
         time_idx = date_timeidx[date]
         mask = np.logical_and(
             simulation.index["time_idx"] == time_idx,
@@ -176,4 +190,16 @@ def forecastDecoratorDeepAR(
         output = output * price
         return output
 
+    # Fitted forecasts are addressed by their inputs in the simulation store
+    forecast.storeKey = contentKey(
+        "DeepAR",
+        {asset: df["Close"].values for asset, df in df_dict.items()},
+        str(split_date),
+        horizon,
+        simulations,
+        max_encoder_length,
+        max_epochs,
+        seed,
+    )
+    forecast.fit = fit
     return forecast
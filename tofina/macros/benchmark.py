@@ -0,0 +1,87 @@
+from tofina.components import portfolio, instrument, asset, strategy
+from tofina.components import optimizer, preference
+import torch
+import time
+
+
+def generateOptionChainPortfolio(
+    strikes: int = 30,
+    processLength: int = 20,
+    monteCarloTrials: int = 5000,
+) -> portfolio.Portfolio:
+    portfolio_ = portfolio.Portfolio(
+        processLength=processLength, monteCarloTrials=monteCarloTrials
+    )
+    portfolio_.addAsset(
+        name="Company",
+        processFn=asset.CompanyValueNormalDistributionProcess,
+        mean=0.01,
+        std=0.1,
+        initialValue=100,
+    )
+    portfolio_.addInstrument(
+        assetName="Company",
+        name="Stock",
+        payoffFn=instrument.NonDerivativePayout,
+        price=100,
+    )
+    for strike in range(strikes):
+        portfolio_.addInstrument(
+            assetName="Company",
+            name="Call" + str(strike),
+            payoffFn=instrument.EuropeanCallPayout,
+            price=5,
+            strikePrice=100 - strikes // 2 + strike,
+            maturity=processLength,
+        )
+    portfolio_.setStrategy(
+        portfolioWeights=torch.linspace(0.1, 1, strikes + 1),
+        liquidationFn=strategy.BuyAndHold,
+        cache_liquidations=True,
+    )
+    return portfolio_
+
+
+def timePerStep(
+    optimizer_: optimizer.Optimizer, iterations: int = 50, warmup: int = 5
+) -> float:
+    optim = optimizer_.initiateOptimizer(
+        [optimizer.WEIGHTS_TARGET], torch.optim.Adam, lr=0.01
+    )
+    for i in range(warmup + iterations):
+        if i == warmup:
+            start = time.perf_counter()
+        optim.zero_grad()
+        optimizer_.calculateUtility()
+        (-optimizer_.utility).backward()
+        optim.step()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmarkCompiledPipeline(
+    iterations: int = 50,
+    warmup: int = 5,
+    compileBackend: str = optimizer.COMPILE_BACKEND,
+    **portfolioKwargs
+) -> dict:
+    """
+    Seconds per optimization step of eager and compiled execution on the
+    same portfolio. Warmup steps (which include compilation) are not timed.
+    """
+    utility = preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityCRRA,
+        timeDiscountFn=preference.InterestRateTimeDiscount,
+        RiskAversion=0.5,
+        interestRate=0.01,
+    )
+    result = {}
+    for mode, compiled in [("eager", False), ("compiled", True)]:
+        optimizer_ = optimizer.Optimizer(
+            portfolio=generateOptionChainPortfolio(**portfolioKwargs),
+            preference=utility,
+            compiled=compiled,
+            compileBackend=compileBackend,
+        )
+        result[mode] = timePerStep(optimizer_, iterations, warmup)
+    result["speedup"] = result["eager"] / result["compiled"]
+    return result
@@ -1,6 +1,6 @@
 from tofina.components import optimizer, logger, preference, portfolio
 import tofina.utils as utils
-from typing import Optional
+from typing import Optional, Union, List
 from copy import deepcopy
 from functools import partial
 
@@ -49,40 +49,62 @@ def optimizeStockBondPortfolioRiskNeutral(
     return portfolioOptimizer
 
 
+def riskAversePreference(
+    RiskAversion: Union[float, List[float]] = 0.5,
+) -> preference.Preference:
+    return preference.Preference(
+        moneyUtilityFn=preference.MoneyUtilityCRRA,
+        timeDiscountFn=preference.NoTimeDiscount,
+        RiskAversion=RiskAversion,
+    )
+
+
 def optimizeStockPortfolioRiskAverse(
     portfolio_: portfolio.Portfolio,
     csvLogFilePath: Optional[str],
-    RiskAversion: float = 0.5,
+    RiskAversion: Union[float, List[float]] = 0.5,
+    compiled: bool = False,
+    utility: Optional[preference.Preference] = None,
     **kwargs
 ) -> optimizer.Optimizer:
+    """
+    utility replaces the default CRRA preference without time discount,
+    RiskAversion is ignored then. kwargs are passed to Optimizer.optimize.
+    """
     logger_ = logger.CsvLogger(filePath=csvLogFilePath)
-    utility = preference.Preference(
-        moneyUtilityFn=preference.MoneyUtilityCRRA,
-        timeDiscountFn=preference.NoTimeDiscount,
-        RiskAversion=RiskAversion,
-    )
+    if utility is None:
+        utility = riskAversePreference(RiskAversion)
     portfolioOptimizer = optimizer.Optimizer(
         portfolio=portfolio_,
         preference=utility,
         logger=logger_,
+        compiled=compiled,
     )
     portfolioOptimizer.registerLoss(
         lossTargets=["utility"],
         lossFn=optimizer.PortfolioOptimizationLoss,
     )
+    # A vector of RiskAversion optimizes one portfolio per level
+    weights = portfolio_.strategy.portfolioWeights
+    levels = range(weights.shape[0]) if weights.ndim > 1 else [None]
     for i, instrument in enumerate(portfolio_.instruments):
 
         def metricFn(x, params, index):
             return utils.tensorToFloat(x[index])
 
-        portfolioOptimizer.registerMetric(
-            instrument + "weight",
-            metricTargets=["portfolio.strategy.normalizedWeights"],
-            metricFn=partial(metricFn, index=i),
-        )
+        for level in levels:
+            name = instrument + "weight"
+            index = i
+            if level is not None:
+                name += "_" + str(level)
+                index = (level, i)
+            portfolioOptimizer.registerMetric(
+                name,
+                metricTargets=["portfolio.strategy.normalizedWeights"],
+                metricFn=partial(metricFn, index=index),
+            )
+    kwargs.setdefault("earlyStoppingTolerance", 1e-8)
     portfolioOptimizer.optimize(
-        paramsToOptimize=["portfolio.strategy.portfolioWeights"],
-        earlyStoppingTolerance=1e-8,
-        **kwargs
+        paramsToOptimize=["portfolio.strategy.portfolioWeights"], **kwargs
     )
     return portfolioOptimizer
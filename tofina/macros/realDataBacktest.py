@@ -1,11 +1,11 @@
 from tofina.components.backtest import Backtester
+from tofina.components.optionData import loadOptionData
 import tofina.components.instrument as instrument
 from tofina.extern.pytorch_forecasting import forecastDecoratorDeepAR
 from tofina.extern.yfinance import loadHistoricalStockData
 import datetime as dt
 from pathlib import Path
 import shutil
-import pandas as pd
 import numpy as np
 
 
@@ -33,13 +33,7 @@ def get_timestamps(stock_data, start_date, end_date):
 
 
 def register_option(df_path, ticker, backtester, start_date, end_date):
-    df = pd.read_csv(df_path)
-    df["Date"] = df["Date"].apply(lambda x: x.replace(" ", ""))
-    df["Expiry Date"] = df["Expiry Date"].apply(lambda x: x.replace(" ", ""))
-    df["Date"] = pd.to_datetime(df["Date"])
-    df["Expiry Date"] = pd.to_datetime(df["Expiry Date"])
-    df = df[df["Date"] >= start_date]
-    df = df[df["Date"] < end_date]
+    df = loadOptionData(df_path, start_date, end_date)
     backtester.parseOptionData(df, ticker, sampleOption=100)
 
 
@@ -42,6 +42,7 @@ def UtilityEqualization(
     iterations: int = 1000,
     lr: float = 0.1,
     early_stop=True,
+    controlVariates: bool = False,
 ) -> None:
     """
     New portfolio and preference derivative pricing model.
@@ -61,6 +62,7 @@ def UtilityEqualization(
         portfolio=zeroDerivativePortfolio,
         preference=utility,
         logger=logger_,
+        controlVariates=controlVariates,
     )
     targetUtility = portfolioOptimizer.utility
     portfolioOptimizer.registerLoss(
@@ -103,6 +105,7 @@ def DerivativePricing(
     earlyStoppingTolerance: float = 0.00001,
     iterations: int = 1000,
     lr: float = 0.1,
+    controlVariates: bool = False,
 ) -> None:
     return UtilityEqualization(
         zeroDerivativePortfolio,
@@ -114,6 +117,7 @@ def DerivativePricing(
         earlyStoppingTolerance,
         iterations,
         lr,
+        controlVariates=controlVariates,
     )
 
 
@@ -126,6 +130,7 @@ def ImpliedVolatility(
     earlyStoppingTolerance: float = 0.00001,
     iterations: int = 1000,
     lr: float = 0.1,
+    controlVariates: bool = False,
 ) -> None:
     return UtilityEqualization(
         zeroDerivativePortfolio,
@@ -138,4 +143,5 @@ def ImpliedVolatility(
         iterations,
         lr,
         False,
+        controlVariates,
     )
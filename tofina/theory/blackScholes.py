@@ -41,11 +41,10 @@ def generateBlackScholesPortfolio(
     impliedVolaility: bool = False,
 ) -> portfolio.Portfolio:
     # http://www.columbia.edu/~mh2078/FoundationsFE/BlackScholes.pdf mu=r
+    # Caches track asset params, so implied volatility needs no special setup
     BlackScholesPortfolio = portfolio.Portfolio(
         processLength=T,
         monteCarloTrials=monteCarloTrials,
-        cache_asset=not impliedVolaility,
-        cache_instrument=not impliedVolaility,
     )
 
     BlackScholesPortfolio.addAsset(
@@ -29,6 +29,7 @@ def GenerateVarianceMinimizationPortfolio(
     covarianceMatrix: torch.Tensor,
     initialValue: torch.Tensor,
     prices: torch.Tensor,
+    monteCarloTrials: int = 100000,
 ) -> portfolio.Portfolio:
     numInstruments = covarianceMatrix.shape[-1]
     companyNames = ["Company" + str(i) for i in range(numInstruments)]
@@ -41,4 +42,5 @@ def GenerateVarianceMinimizationPortfolio(
             "covarianceMatrix": covarianceMatrix,
             "initialValue": initialValue,
         },
+        monteCarloTrials=monteCarloTrials,
     )
@@ -1,8 +1,11 @@
 import torch
 import math
+import weakref
 from typing import List
 
 TOLERANCE = 0.001
+# Fewer trials per control overfit the regression and bias the estimate
+TRIALS_PER_CONTROL_VARIATE = 10
 
 
 def convertKwargsToTorchParameters(kwargs: dict) -> dict:
@@ -19,6 +22,69 @@ def convertKwargsToTorchParameters(kwargs: dict) -> dict:
     return params
 
 
+def controlVariateAdjustment(
+    samples: torch.Tensor, controls: torch.Tensor
+) -> torch.Tensor:
+    """
+    Removes from samples (trials x ...) the part explained by zero-mean
+    controls (trials x controls). Mean of the result is the control variate
+    estimator; regression coefficients are fitted on the same trials and
+    are not differentiated through. With fewer than TRIALS_PER_CONTROL_VARIATE
+    trials per control the samples are returned unadjusted.
+    """
+    trials = samples.shape[0]
+    if controls.shape[1] * TRIALS_PER_CONTROL_VARIATE > trials:
+        return samples
+    controls = controls.to(samples.dtype)
+    with torch.no_grad():
+        centeredControls = controls - controls.mean(axis=0)
+        centeredSamples = samples.reshape(trials, -1)
+        centeredSamples = centeredSamples - centeredSamples.mean(axis=0)
+        beta = torch.linalg.lstsq(centeredControls, centeredSamples).solution
+    return samples - (controls @ beta).reshape(samples.shape)
+
+
+def flattenTensors(value) -> List[torch.Tensor]:
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [tensor for item in value for tensor in flattenTensors(item)]
+    return []
+
+
+def tensorVersions(value) -> tuple:
+    """
+    Snapshot of the tensors in a nested structure: weak references to them,
+    their in-place version counters and whether a result computed from them
+    now would carry an autograd graph.
+    """
+    tensors = flattenTensors(value)
+    tracksGrad = torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+    return tracksGrad, [(weakref.ref(t), t._version) for t in tensors]
+
+
+def versionsMatch(old: tuple, new: tuple) -> bool:
+    oldTracksGrad, oldTensors = old
+    newTracksGrad, newTensors = new
+    if oldTracksGrad != newTracksGrad or len(oldTensors) != len(newTensors):
+        return False
+    return all(
+        oldRef() is newRef() and oldVersion == newVersion
+        for (oldRef, oldVersion), (newRef, newVersion) in zip(oldTensors, newTensors)
+    )
+
+
+def sameTensorView(x: torch.Tensor, y: torch.Tensor) -> bool:
+    return (
+        x.data_ptr() == y.data_ptr()
+        and x.shape == y.shape
+        and x.stride() == y.stride()
+        and x.dtype == y.dtype
+    )
+
+
 def check_equality(x: torch.Tensor, y: torch.Tensor) -> bool:
     return ((x - y).abs() < TOLERANCE).all()
 